@@ -6,3 +6,5 @@ admin.site.register(md.DeezerTrack)
 admin.site.register(md.Playlist)
 admin.site.register(md.TrackIdentity)
 admin.site.register(md.User)
+admin.site.register(md.DeezerMatch)
+admin.site.register(md.DeezerMiss)
@@ -0,0 +1,127 @@
+""" Loaders for mass insertion of model instances.
+
+`BulkLoader` works with any database and inserts rows by chunked
+`bulk_create`. `CopyLoader` streams rows into `COPY ... FROM STDIN`
+and requires PostgreSQL (`BulkLoader` is used for other databases).
+"""
+import logging
+from io import TextIOBase
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections, router
+
+
+logger = logging.getLogger(__name__)
+
+BULK = 'bulk'
+COPY = 'copy'
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def get_loader(backend=None, batch_size=None):
+    """ Returns loader by `backend` name (one of `BULK` or `COPY`),
+    `settings.IMPORT_LOADER` is used by default.
+    """
+    backend = backend or settings.IMPORT_LOADER
+    batch_size = batch_size or settings.IMPORT_BATCH_SIZE
+    if backend == BULK:
+        return BulkLoader(batch_size)
+    if backend == COPY:
+        return CopyLoader(batch_size)
+    raise ValueError(f'unknown import loader: `{backend}`')
+
+
+class BulkLoader:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+
+    def insert(self, model, objs) -> int:
+        """ Inserts `objs` (model instances) and returns inserted count.
+        Primary keys are not set to `objs`.
+        """
+        inserted_cnt = 0
+        for chunk in chunked(objs, self.batch_size):
+            model.objects.bulk_create(chunk)
+            inserted_cnt += len(chunk)
+        return inserted_cnt
+
+
+class CopyLoader(BulkLoader):
+    def insert(self, model, objs) -> int:
+        connection = connections[router.db_for_write(model)]
+        if connection.vendor != 'postgresql':
+            logger.debug('COPY is unsupported by %s', connection.vendor)
+            return super(CopyLoader, self).insert(model, objs)
+
+        fields = [
+            field for field in model._meta.concrete_fields
+            if field != model._meta.auto_field
+        ]
+        columns = ', '.join(
+            connection.ops.quote_name(field.column) for field in fields
+        )
+        sql = (
+            f'COPY {connection.ops.quote_name(model._meta.db_table)} '
+            f'({columns}) FROM STDIN'
+        )
+
+        stream = _CopyStream(
+            [
+                field.get_db_prep_save(getattr(obj, field.attname), connection)
+                for field in fields
+            ]
+            for obj in objs
+        )
+        with connection.cursor() as cursor:
+            cursor.copy_expert(sql, stream, size=_CopyStream.BUFFER_SIZE)
+        return stream.rows_cnt
+
+
+class _CopyStream(TextIOBase):
+    """ File-like object which formats rows to COPY text format on reading
+    """
+    BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+        self._buffer = ''
+        self.rows_cnt = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self._buffer += '\t'.join(map(_copy_value, row)) + '\n'
+            self.rows_cnt += 1
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return r'\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
@@ -0,0 +1,65 @@
+import logging
+
+import Levenshtein
+from django.conf import settings
+
+from .deezer_base import request
+
+# https://developers.deezer.com/api/search/album
+# https://developers.deezer.com/api/album/tracks
+
+SEARCH_URL = f'{settings.DEEZER_API_URL}/search/album'
+TRACKS_URL = f'{settings.DEEZER_API_URL}/album/{{album_id}}/tracks'
+SEARCH_LIMIT = 10
+TRACKS_LIMIT = 500
+
+logger = logging.getLogger(__name__)
+
+
+def query(artist, album) -> str:
+    return f'artist:"{artist}" album:"{album}"'
+
+
+def search(artist, album, token=None):
+    """ Returns the closest to `artist` and `album` Deezer album or None
+    """
+    params = {'q': query(artist, album), 'limit': SEARCH_LIMIT}
+    if token:
+        params['access_token'] = token
+
+    albums = request(SEARCH_URL, params)
+    logger.debug("deezer response on album '%s - %s' with %s albums",
+                 artist, album, len(albums))
+    if not albums:
+        return None
+
+    return min(albums, key=lambda album_info: (
+        Levenshtein.distance(artist or '', album_info['artist']['name'])
+        + Levenshtein.distance(album, album_info['title'])
+    ))
+
+
+def tracks(album_info, token=None) -> list:
+    """ Returns tracks of Deezer album in search response format
+    """
+    params = {'limit': TRACKS_LIMIT}
+    if token:
+        params['access_token'] = token
+
+    track_infos = request(
+        TRACKS_URL.format(album_id=album_info['id']), params,
+    )
+    # album is not included in tracks of album
+    return [
+        dict(track_info, album={'title': album_info['title']})
+        for track_info in track_infos
+    ]
+
+
+def search_tracks(artist, album, token=None) -> list:
+    """ Returns tracks of the closest to `artist` and `album` Deezer album
+    """
+    album_info = search(artist, album, token)
+    if not album_info:
+        return []
+    return tracks(album_info, token)
@@ -0,0 +1,272 @@
+""" Asyncio counterparts of `deezer_base.request` and `deezer_search`.
+
+Many searches are requested from one event loop, at most
+`DEEZER_ASYNC_CONNECTIONS` of them are in flight (see `Searcher`), their
+rate is limited by Deezer quota (see `deezer_quota`). Coroutines return
+Deezer API data and do not use database: tracks are saved by the calling
+code (see `matching.search_unpaired`).
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import aclosing
+from itertools import count
+
+import aiohttp
+from django.conf import settings
+
+from . import deezer_quota
+from .deezer_base import (
+    DeezerResponseError, IDEMPOTENT_METHODS, QUOTA_EXCEEDED, backoff_delay,
+    get_breaker, get_limiter, parse,
+)
+from .deezer_cache import get_cache, make_key
+from .deezer_search import (
+    CONCURRENT, EARLY_EXIT, LIMIT, SEARCH_URL, SEQUENTIAL, advanced_query,
+    closest, combined_queries, is_enough, simple_query,
+)
+from .. import models as md
+
+
+logger = logging.getLogger(__name__)
+
+ASYNCIO = 'asyncio'
+
+
+def client_session() -> aiohttp.ClientSession:
+    """ Returns session with `DEEZER_ASYNC_CONNECTIONS` connections at most,
+    it should be used as async context manager
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=settings.DEEZER_ASYNC_CONNECTIONS),
+        timeout=aiohttp.ClientTimeout(
+            sock_connect=settings.DEEZER_CONNECT_TIMEOUT,
+            sock_read=settings.DEEZER_READ_TIMEOUT,
+        ),
+    )
+
+
+async def send(session, method, url, acquire=None, **kwargs):
+    """ Async `deezer_base.send`, returns response json. `acquire` is
+    coroutine function.
+    """
+    retry = method.lower() in IDEMPOTENT_METHODS
+    for attempt in count():
+        last = not retry or attempt >= settings.DEEZER_RETRIES
+        if acquire:
+            await acquire()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status < 500 or last:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+                logger.warning('%s %s: %s response, retrying',
+                               method, url, response.status)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if last:
+                raise
+            logger.warning('%s %s failed, retrying', method, url)
+        await asyncio.sleep(backoff_delay(attempt))
+
+
+async def request(session, url, params, method='get'):
+    """ Async `deezer_base.request`
+    """
+    for attempt in count():
+        try:
+            return await _request(session, url, params, method)
+        except DeezerResponseError as exc:
+            if exc.code != QUOTA_EXCEEDED \
+                    or attempt >= settings.DEEZER_RETRIES:
+                raise
+            logger.warning('Deezer quota exceeded, retrying %s', url)
+        await asyncio.sleep(backoff_delay(attempt))
+
+
+async def _request(session, url, params, method):
+    endpoint = deezer_quota.endpoint(url)
+    breaker = get_breaker()
+    breaker.before(endpoint)
+    # the probe of half-open circuit is released on every exit
+    start = None
+
+    async def _acquire():
+        nonlocal start
+        # limiter may block: it waits in thread, event loop is free
+        await asyncio.to_thread(
+            get_limiter().acquire, endpoint, deezer_quota.user(params),
+        )
+        start = start or time.monotonic()
+
+    try:
+        json = await send(
+            session, method, url, acquire=_acquire, params=params,
+        )
+    except Exception as exc:
+        if start is None:
+            breaker.cancel(endpoint)
+        else:
+            breaker.record(endpoint, time.monotonic() - start, is_failure(exc))
+        raise
+    except BaseException:
+        # cancelled
+        breaker.cancel(endpoint)
+        raise
+    breaker.record(endpoint, time.monotonic() - start, False)
+    return parse(json, url, params)
+
+
+def is_failure(exc) -> bool:
+    """ Async `deezer_base.is_failure`
+    """
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500
+    return isinstance(
+        exc, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+async def search(session, query, token=None, limit=None) -> list:
+    """ Returns Deezer tracks data found by `query`
+    """
+    limit = limit or LIMIT
+    cache = get_cache()
+    cache_key = make_key(query, limit)
+    # cache backend may block (redis): it is called in thread
+    deezer_data = await asyncio.to_thread(cache.get, cache_key)
+    if deezer_data is not None:
+        logger.debug("cached deezer response on '%s'", query)
+        return deezer_data
+
+    params = {'q': query, 'limit': limit}
+    if token:
+        params['access_token'] = token
+
+    deezer_data = await request(session, SEARCH_URL, params)
+    logger.debug("deezer response on '%s' with %s tracks", query, len(deezer_data))
+    await asyncio.to_thread(cache.set, cache_key, deezer_data)
+    return deezer_data
+
+
+async def simple(
+    session, track: md.UserTrack, with_album=True, token=None, limit=None,
+) -> list:
+    return await search(session, simple_query(track, with_album), token, limit)
+
+
+async def advanced(
+    session, track: md.UserTrack, with_album=True, token=None, limit=None,
+) -> list:
+    return await search(
+        session, advanced_query(track, with_album), token, limit)
+
+
+async def combined(session, track: md.UserTrack, token=None, strategy=None):
+    """ Async `deezer_search.combined`. `DeezerMatch` and `DeezerMiss` are
+    not used.
+
+    Returns Deezer tracks data with the closest to `track` candidate or
+    None, when nothing is found.
+    """
+    strategy = strategy or settings.DEEZER_SEARCH_STRATEGY
+    if strategy in (SEQUENTIAL, EARLY_EXIT):
+        responses = _search_sequentially(session, track, token)
+    elif strategy == CONCURRENT:
+        responses = _search_concurrently(session, track, token)
+    else:
+        raise ValueError(f'unknown Deezer search strategy: `{strategy}`')
+
+    best = None
+    async with aclosing(responses):
+        async for deezer_data in responses:
+            best = closest(track, best, deezer_data)
+            if is_enough(best, strategy):
+                break
+    return best[0] if best else None
+
+
+async def _search_sequentially(session, track, token=None):
+    for query in combined_queries(track):
+        yield await search(session, query, token)
+
+
+async def _search_concurrently(session, track, token=None):
+    tasks = [
+        asyncio.ensure_future(search(session, query, token))
+        for query in combined_queries(track)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class Searcher:
+    """ Event loop in thread with one client session, so the whole search
+    job shares them: searches of many `request_many` calls are in flight
+    together, `DEEZER_ASYNC_CONNECTIONS` at most. Use as context manager.
+    """
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='deezer-async', daemon=True,
+        )
+        self._session = None
+        self._semaphore = None
+        self._futures = set()
+
+    def __enter__(self):
+        self._thread.start()
+        self._session, self._semaphore = self._run(self._open())
+        return self
+
+    def __exit__(self, *exc_info):
+        for future in list(self._futures):
+            future.cancel()
+        self._run(self._session.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def request_many(
+        self, tracks, query=simple_query, token=None, limit=None,
+    ) -> Future:
+        """ Async `deezer_search.request_many`, returns future of its
+        result at once
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._request_many(list(tracks), query, token, limit), self._loop,
+        )
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+    async def _open(self):
+        return (
+            client_session(),
+            asyncio.Semaphore(settings.DEEZER_ASYNC_CONNECTIONS),
+        )
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def _request_many(self, tracks, query, token=None, limit=None):
+        async def _search(track):
+            try:
+                async with self._semaphore:
+                    return await search(
+                        self._session, query(track), token, limit,
+                    )
+            except Exception:
+                logger.exception('search failed for %s', track)
+
+        responses = await asyncio.gather(*map(_search, tracks))
+        return {
+            track: deezer_data
+            for track, deezer_data in zip(tracks, responses)
+            if deezer_data is not None
+        }
@@ -6,7 +6,7 @@ from urllib.parse import urlencode
 import requests
 from django.conf import settings
 
-from .deezer_base import DeezerAuthRejected, DeezerUnexpectedResponse
+from .deezer_base import DeezerAuthRejected, DeezerUnexpectedResponse, send
 
 logger = logging.getLogger(__name__)
 __dt_format = '%Y.%m.%d %H:%M:%S'
@@ -57,7 +57,7 @@ def __build_auth_url(redirect_uri, request) -> str:
         'redirect_uri': redirect_uri,
         'perms': settings.DEEZER_BASE_PERMS,
     })
-    return f'https://connect.deezer.com/oauth/auth.php?{params}'
+    return f'{settings.DEEZER_CONNECT_URL}/oauth/auth.php?{params}'
 
 
 def get_token(request) -> TokenInfo:
@@ -68,13 +68,12 @@ def get_token(request) -> TokenInfo:
         logger.warning('auth rejected')
         raise DeezerAuthRejected('auth rejected')
 
-    url = 'https://connect.deezer.com/oauth/access_token.php?'
+    url = f'{settings.DEEZER_CONNECT_URL}/oauth/access_token.php?'
     params = {
         'app_id': settings.DEEZER_APP_ID, 'secret': settings.DEEZER_SECRET_KEY,
         'code': code
     }
-    resp = requests.post(url, params)
-    resp.raise_for_status()
+    resp = send('post', url, data=params)
 
     token, seconds_left = __parse_deezer_response(resp)
     expires_time = datetime.now() + timedelta(seconds=seconds_left)
@@ -96,9 +95,8 @@ def __parse_deezer_response(response: requests.Response) -> Tuple[str, int]:
 
 
 def about_user(token) -> AboutUser:
-    url = 'https://api.deezer.com/user/me'
-    resp = requests.get(url, {'access_token': token})
-    resp.raise_for_status()
+    url = f'{settings.DEEZER_API_URL}/user/me'
+    resp = send('get', url, params={'access_token': token})
 
     info = resp.json()
     error = info.get('error')
@@ -1,4 +1,22 @@
+import logging
+import time
+from itertools import count
+
 import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from . import deezer_quota
+from .deezer_breaker import DeezerUnavailable, get_breaker  # noqa: F401
+from .deezer_quota import get_limiter
+
+
+logger = logging.getLogger(__name__)
+
+# https://developers.deezer.com/api/errors
+QUOTA_EXCEEDED = 4
+# 5xx responses and network errors are retried for these methods only
+IDEMPOTENT_METHODS = ('get', 'head', 'options')
 
 
 class DeezerAuthRejected(Exception):
@@ -20,11 +38,114 @@ class DeezerResponseError(Exception):
         return f'{self.type}: {self.message} ({self.message})'
 
 
+_session = None
+
+
+def get_session() -> requests.Session:
+    """ Returns process-wide session, which keeps connections to Deezer
+    alive and reuses them
+    """
+    global _session
+    if _session is None:
+        adapter = HTTPAdapter(pool_maxsize=settings.DEEZER_POOL_SIZE)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+    return _session
+
+
+def send(method, url, acquire=None, **kwargs) -> requests.Response:
+    """ Sends HTTP request by shared session with `DEEZER_CONNECT_TIMEOUT`
+    and `DEEZER_READ_TIMEOUT`. Requests of idempotent methods are retried
+    `DEEZER_RETRIES` times on 5xx responses and network errors.
+    `acquire` (if any) is called before every attempt, so retries wait for
+    Deezer quota too.
+    """
+    retry = method.lower() in IDEMPOTENT_METHODS
+    timeout = settings.DEEZER_CONNECT_TIMEOUT, settings.DEEZER_READ_TIMEOUT
+    for attempt in count():
+        last = not retry or attempt >= settings.DEEZER_RETRIES
+        if acquire:
+            acquire()
+        try:
+            response = get_session().request(
+                method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+            logger.warning('%s %s failed, retrying', method, url)
+        else:
+            if response.status_code < 500 or last:
+                response.raise_for_status()
+                return response
+            logger.warning('%s %s: %s response, retrying',
+                           method, url, response.status_code)
+        backoff(attempt)
+
+
+def backoff(attempt):
+    time.sleep(backoff_delay(attempt))
+
+
+def backoff_delay(attempt) -> float:
+    return settings.DEEZER_BACKOFF * 2 ** attempt
+
+
 def request(url, params, method='get'):
-    response = requests.request(method, url, params=params)
-    response.raise_for_status()
-    json = response.json()
+    """ Returns data of Deezer API response. Request waits for Deezer
+    quota (see `deezer_quota`) and is retried `DEEZER_RETRIES` times, when
+    quota is exceeded anyway. `DeezerUnavailable` is raised at once, when
+    circuit of API endpoint is open (see `deezer_breaker`).
+    """
+    for attempt in count():
+        try:
+            return _request(url, params, method)
+        except DeezerResponseError as exc:
+            if exc.code != QUOTA_EXCEEDED \
+                    or attempt >= settings.DEEZER_RETRIES:
+                raise
+            logger.warning('Deezer quota exceeded, retrying %s', url)
+        backoff(attempt)
+
+
+def _request(url, params, method):
+    endpoint = deezer_quota.endpoint(url)
+    breaker = get_breaker()
+    breaker.before(endpoint)
+    # the probe of half-open circuit is released on every exit
+    start = None
+
+    def _acquire():
+        nonlocal start
+        get_limiter().acquire(endpoint, deezer_quota.user(params))
+        start = start or time.monotonic()
+
+    try:
+        response = send(method, url, acquire=_acquire, params=params)
+    except Exception as exc:
+        if start is None:
+            breaker.cancel(endpoint)
+        else:
+            breaker.record(endpoint, time.monotonic() - start, is_failure(exc))
+        raise
+    except BaseException:
+        breaker.cancel(endpoint)
+        raise
+    breaker.record(endpoint, time.monotonic() - start, False)
+    return parse(response.json(), url, params)
+
+
+def is_failure(exc) -> bool:
+    """ Returns True, when `exc` means Deezer is unavailable
+    """
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is None or exc.response.status_code >= 500
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
 
+def parse(json, url, params):
+    """ Returns data of Deezer API response `json` or raises error
+    """
     if isinstance(json, bool):
         if not json:
             raise DeezerUnexpectedResponse(
@@ -0,0 +1,183 @@
+""" Circuit breaker of Deezer API endpoints.
+
+Calls of every endpoint for the last `DEEZER_BREAKER_WINDOW` seconds are
+tracked. Circuit of endpoint is opened, when at least
+`DEEZER_BREAKER_MIN_CALLS` calls were made and rate of failed (network
+errors, 5xx responses) or slow (longer than `DEEZER_BREAKER_SLOW_CALL`
+seconds) calls reaches `DEEZER_BREAKER_ERROR_RATE` or
+`DEEZER_BREAKER_SLOW_RATE`.
+
+Calls of open circuit fail at once. After `DEEZER_BREAKER_OPEN_TIME`
+seconds circuit is half-open: the single probe call is allowed, circuit is
+closed, when it succeeds, and opened again otherwise.
+
+State is kept by the current process.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class DeezerUnavailable(Exception):
+    pass
+
+
+class _Circuit:
+    def __init__(self):
+        self.state = CLOSED
+        self.opened = 0
+        self.probing = False
+        # (time, failed, slow)
+        self.calls = deque()
+
+
+class CircuitBreaker:
+    # `wait` checks result of probe call every `PROBE_POLL` seconds
+    PROBE_POLL = 0.05
+
+    def __init__(
+        self, window, min_calls, error_rate, slow_call, slow_rate, open_time,
+    ):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_time = open_time
+        self._lock = threading.Lock()
+        self._circuits = {}
+
+    def before(self, endpoint):
+        """ Raises `DeezerUnavailable`, when call of `endpoint` is not
+        allowed
+        """
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == OPEN \
+                    and time.monotonic() - circuit.opened >= self.open_time:
+                circuit.state = HALF_OPEN
+            if circuit.state == CLOSED:
+                return
+            if circuit.state == HALF_OPEN and not circuit.probing:
+                circuit.probing = True
+                return
+        raise DeezerUnavailable(f'Deezer `{endpoint}` is unavailable')
+
+    def record(self, endpoint, latency, failed):
+        """ Tracks call of `endpoint`, which took `latency` seconds
+        """
+        now = time.monotonic()
+        slow = latency > self.slow_call
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == HALF_OPEN:
+                circuit.probing = False
+                circuit.calls.clear()
+                if failed or slow:
+                    self._open(endpoint, circuit, now)
+                else:
+                    circuit.state = CLOSED
+                    logger.info('Deezer `%s` circuit is closed', endpoint)
+                return
+
+            circuit.calls.append((now, failed, slow))
+            while circuit.calls and circuit.calls[0][0] < now - self.window:
+                circuit.calls.popleft()
+
+            calls = len(circuit.calls)
+            if circuit.state != CLOSED or calls < self.min_calls:
+                return
+            errors = sum(failed for _, failed, _ in circuit.calls)
+            slows = sum(slow for _, _, slow in circuit.calls)
+            if errors / calls >= self.error_rate \
+                    or slows / calls >= self.slow_rate:
+                self._open(endpoint, circuit, now)
+
+    def cancel(self, endpoint):
+        """ Forgets call of `endpoint`, which was cancelled before result
+        """
+        with self._lock:
+            self._circuit(endpoint).probing = False
+
+    def _open(self, endpoint, circuit, now):
+        logger.warning('Deezer `%s` circuit is open', endpoint)
+        circuit.state = OPEN
+        circuit.opened = now
+
+    def _circuit(self, endpoint) -> _Circuit:
+        if endpoint not in self._circuits:
+            self._circuits[endpoint] = _Circuit()
+        return self._circuits[endpoint]
+
+    def state(self, endpoint) -> str:
+        with self._lock:
+            circuit = self._circuit(endpoint)
+            if circuit.state == OPEN \
+                    and time.monotonic() - circuit.opened >= self.open_time:
+                return HALF_OPEN
+            return circuit.state
+
+    def wait(self, endpoint):
+        """ Blocks while circuit of `endpoint` is open or its probe call is
+        in flight, so batch jobs pause instead of failing
+        """
+        while True:
+            with self._lock:
+                circuit = self._circuit(endpoint)
+                if circuit.state == HALF_OPEN and circuit.probing:
+                    left = None
+                elif circuit.state == OPEN:
+                    left = circuit.opened + self.open_time - time.monotonic()
+                    if left <= 0:
+                        return
+                else:
+                    return
+            if left is None:
+                time.sleep(self.PROBE_POLL)
+                continue
+            logger.info('Deezer `%s` is unavailable, pause for %.1f sec',
+                        endpoint, left)
+            time.sleep(left)
+
+    def stats(self) -> dict:
+        with self._lock:
+            endpoints = list(self._circuits)
+        result = {}
+        for endpoint in endpoints:
+            with self._lock:
+                calls = list(self._circuits[endpoint].calls)
+            result[endpoint] = dict(
+                state=self.state(endpoint), calls=len(calls),
+                errors=sum(failed for _, failed, _ in calls),
+                slow=sum(slow for _, _, slow in calls),
+            )
+        return result
+
+
+_breaker = None
+
+
+def get_breaker() -> CircuitBreaker:
+    """ Returns process-wide circuit breaker
+    """
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(
+            window=settings.DEEZER_BREAKER_WINDOW,
+            min_calls=settings.DEEZER_BREAKER_MIN_CALLS,
+            error_rate=settings.DEEZER_BREAKER_ERROR_RATE,
+            slow_call=settings.DEEZER_BREAKER_SLOW_CALL,
+            slow_rate=settings.DEEZER_BREAKER_SLOW_RATE,
+            open_time=settings.DEEZER_BREAKER_OPEN_TIME,
+        )
+    return _breaker
@@ -0,0 +1,170 @@
+""" Cache of Deezer search responses.
+
+Responses are cached by normalized query and limit for `DEEZER_CACHE_TTL`
+seconds, at most `DEEZER_CACHE_MAX_SIZE` responses are kept (least recently
+used ones are evicted). Backends (`DEEZER_CACHE_BACKEND`) are:
+* `memory` - cache of the current process;
+* `redis` - cache shared by all processes (`DEEZER_CACHE_REDIS_URL`);
+* `none` - caching is disabled.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY = 'memory'
+REDIS = 'redis'
+NONE = 'none'
+
+
+def normalize_query(query) -> str:
+    return ' '.join(query.lower().split())
+
+
+def make_key(query, limit) -> str:
+    return f'{limit}:{normalize_query(query)}'
+
+
+class NullCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def stats(self) -> dict:
+        return dict(backend=NONE)
+
+
+class MemoryCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (expires, value)
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._data.get(key, (0, None))
+            if expires < time.monotonic():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> dict:
+        return dict(
+            backend=MEMORY, hits=self.hits, misses=self.misses,
+            size=len(self._data),
+        )
+
+
+class RedisCache:
+    """ Values are stored as json with TTL, keys are indexed in sorted set
+    by last access time to evict least recently used ones. When Redis is
+    unavailable, values are missed and not stored, so search goes on.
+    """
+    PREFIX = 'ideezer:deezer_search:'
+
+    def __init__(self, url, ttl, max_size):
+        import redis
+
+        self.ttl = ttl
+        self.max_size = max_size
+        self._redis = redis.Redis.from_url(url)
+        self._errors = (redis.RedisError,)
+        self._index = f'{self.PREFIX}index'
+        self._hits = f'{self.PREFIX}hits'
+        self._misses = f'{self.PREFIX}misses'
+
+    def get(self, key):
+        try:
+            return self._get(key)
+        except self._errors:
+            logger.exception('Redis cache is unavailable')
+            return None
+
+    def set(self, key, value):
+        try:
+            self._set(key, value)
+        except self._errors:
+            logger.exception('Redis cache is unavailable')
+
+    def _get(self, key):
+        value = self._redis.get(self.PREFIX + key)
+        if value is None:
+            self._redis.incr(self._misses)
+            return None
+
+        pipe = self._redis.pipeline()
+        pipe.incr(self._hits)
+        pipe.zadd(self._index, {key: time.time()})
+        pipe.execute()
+        return json.loads(value)
+
+    def _set(self, key, value):
+        pipe = self._redis.pipeline()
+        pipe.set(self.PREFIX + key, json.dumps(value), ex=self.ttl)
+        pipe.zadd(self._index, {key: time.time()})
+        pipe.zcard(self._index)
+        *_, size = pipe.execute()
+
+        if size > self.max_size:
+            evicted = self._redis.zpopmin(self._index, size - self.max_size)
+            keys = [self.PREFIX + name.decode() for name, _ in evicted]
+            if keys:
+                self._redis.delete(*keys)
+
+    def stats(self) -> dict:
+        pipe = self._redis.pipeline()
+        pipe.get(self._hits)
+        pipe.get(self._misses)
+        # expired keys are in the index until they are evicted
+        pipe.zcard(self._index)
+        hits, misses, size = pipe.execute()
+        return dict(
+            backend=REDIS, hits=int(hits or 0), misses=int(misses or 0),
+            size=size,
+        )
+
+
+_cache = None
+
+
+def get_cache():
+    """ Returns process-wide cache by `settings.DEEZER_CACHE_BACKEND`
+    """
+    global _cache
+    if _cache is None:
+        _cache = _create_cache(settings.DEEZER_CACHE_BACKEND)
+    return _cache
+
+
+def _create_cache(backend):
+    ttl = settings.DEEZER_CACHE_TTL
+    max_size = settings.DEEZER_CACHE_MAX_SIZE
+    if backend == MEMORY:
+        return MemoryCache(ttl, max_size)
+    if backend == REDIS:
+        return RedisCache(settings.DEEZER_CACHE_REDIS_URL, ttl, max_size)
+    if backend == NONE:
+        return NullCache()
+    raise ValueError(f'unknown Deezer cache backend: `{backend}`')
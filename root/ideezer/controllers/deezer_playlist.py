@@ -1,5 +1,7 @@
 import logging
 
+from django.conf import settings
+
 from .deezer_base import request
 from .. import models as md
 
@@ -8,9 +10,9 @@ from .. import models as md
 logger = logging.getLogger(__name__)
 
 
-CREATE_URL = 'https://api.deezer.com/user/me/playlists'
-ADDTRACKS_URL = 'https://api.deezer.com/playlist/{playlist_id}/tracks'
-INFO_URL = 'https://api.deezer.com/playlist/{playlist_id}'
+CREATE_URL = f'{settings.DEEZER_API_URL}/user/me/playlists'
+ADDTRACKS_URL = f'{settings.DEEZER_API_URL}/playlist/{{playlist_id}}/tracks'
+INFO_URL = f'{settings.DEEZER_API_URL}/playlist/{{playlist_id}}'
 
 
 def create(playlist: md.Playlist, token):
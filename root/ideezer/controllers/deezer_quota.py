@@ -0,0 +1,242 @@
+""" Limiters of Deezer API requests.
+
+Every request takes a token from buckets (all buckets are refilled
+continuously, `calls` tokens per `period` seconds):
+* user bucket (`DEEZER_USER_QUOTA_CALLS`) - requests with the same access
+  token;
+* endpoint bucket (`DEEZER_ENDPOINT_QUOTAS`) - requests of the same API
+  endpoint (`search`, `playlist`, ...), only listed endpoints are limited;
+* application bucket (`DEEZER_QUOTA_CALLS`) - all requests. Waiting
+  requests take its tokens in order of arrival.
+
+Backends (`DEEZER_LIMITER_BACKEND`) are:
+* `memory` - buckets of the current process;
+* `redis` - buckets shared by all processes (`DEEZER_LIMITER_REDIS_URL`),
+  buckets of the current process are used while Redis is unavailable.
+"""
+import hashlib
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from urllib.parse import urlparse
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY = 'memory'
+REDIS = 'redis'
+
+APP = 'app'
+
+
+def endpoint(url) -> str:
+    """ Returns the first part of Deezer API url path,
+    e.g. `playlist` for `https://api.deezer.com/playlist/1/tracks`
+    """
+    return urlparse(url).path.strip('/').split('/')[0]
+
+
+def user(params) -> str:
+    """ Returns user (hash of access token) of request `params` or None
+    """
+    token = (params or {}).get('access_token')
+    if token:
+        return hashlib.sha1(token.encode()).hexdigest()[:16]
+
+
+class RateLimiter:
+    """ Allows at most `calls` per `period` seconds (sliding window).
+    Thread-safe.
+    """
+    def __init__(self, calls, period):
+        self.calls = calls
+        self.period = period
+        self._lock = threading.Lock()
+        self._times = deque()
+
+    def acquire(self):
+        """ Blocks until call is allowed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._times and self._times[0] <= now - self.period:
+                    self._times.popleft()
+                if len(self._times) < self.calls:
+                    self._times.append(now)
+                    return
+                wait = self._times[0] + self.period - now
+            time.sleep(wait)
+
+
+class Quotas:
+    """ Buckets `(name, calls, period)` of request
+    """
+    def __init__(self, calls, period, user_calls, endpoint_calls):
+        self.calls = calls
+        self.period = period
+        self.user_calls = user_calls
+        self.endpoint_calls = endpoint_calls
+
+    def buckets(self, endpoint_name, user_name):
+        if user_name and self.user_calls:
+            yield f'user:{user_name}', self.user_calls, self.period
+        if endpoint_name in self.endpoint_calls:
+            yield (
+                f'endpoint:{endpoint_name}',
+                self.endpoint_calls[endpoint_name], self.period,
+            )
+        yield APP, self.calls, self.period
+
+
+class LocalLimiter:
+    """ Buckets of the current process
+    """
+    def __init__(self, quotas):
+        self.quotas = quotas
+        self._lock = threading.Lock()
+        self._limiters = {}
+
+    def acquire(self, endpoint_name='', user_name=None):
+        """ Blocks until request to `endpoint_name` by `user_name` is allowed
+        """
+        for bucket in self.quotas.buckets(endpoint_name, user_name):
+            self._limiter(bucket).acquire()
+
+    def _limiter(self, bucket) -> RateLimiter:
+        name, calls, period = bucket
+        with self._lock:
+            if name not in self._limiters:
+                self._limiters[name] = RateLimiter(calls, period)
+            return self._limiters[name]
+
+
+# KEYS: bucket hash [, queue sorted set, last seen sorted set]
+# ARGV: capacity, refill per second, ttl, waiter, queue timeout
+# Returns seconds to wait as string, '0' when token is taken.
+# Queue keeps arrival time of waiters, last seen - time of their last call:
+# waiters, which were not seen for queue timeout, are dropped.
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local queue = KEYS[2]
+local seen = KEYS[3]
+if queue then
+    local expired = now - tonumber(ARGV[5])
+    for _, waiter in ipairs(
+        redis.call('ZRANGEBYSCORE', seen, '-inf', expired)
+    ) do
+        redis.call('ZREM', queue, waiter)
+    end
+    redis.call('ZREMRANGEBYSCORE', seen, '-inf', expired)
+    redis.call('ZADD', queue, 'NX', now, ARGV[4])
+    redis.call('ZADD', seen, now, ARGV[4])
+    redis.call('EXPIRE', queue, ARGV[3])
+    redis.call('EXPIRE', seen, ARGV[3])
+    if redis.call('ZRANGE', queue, 0, 0)[1] ~= ARGV[4] then
+        return tostring(1 / rate)
+    end
+end
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local wait = '0'
+if tokens < 1 then
+    wait = tostring((1 - tokens) / rate)
+else
+    tokens = tokens - 1
+    if queue then
+        redis.call('ZREM', queue, ARGV[4])
+        redis.call('ZREM', seen, ARGV[4])
+    end
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return wait
+"""
+
+
+class RedisLimiter:
+    """ Token buckets shared by all processes. Tokens are taken by Lua
+    script, so buckets are consistent without locks.
+    """
+    PREFIX = 'ideezer:deezer_quota:'
+    # waiters, which have not called for this time, are dropped from queue
+    # (so queue is not blocked by dead processes); live waiters call every
+    # `MAX_WAIT` seconds and keep their place
+    QUEUE_TIMEOUT = 30
+    MAX_WAIT = 1
+
+    def __init__(self, url, quotas):
+        import redis
+
+        self.quotas = quotas
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(TAKE_SCRIPT)
+        self._errors = (redis.RedisError,)
+        self._fallback = LocalLimiter(quotas)
+
+    def acquire(self, endpoint_name='', user_name=None):
+        """ Blocks until request to `endpoint_name` by `user_name` is allowed
+        """
+        waiter = uuid.uuid4().hex
+        try:
+            for bucket in self.quotas.buckets(endpoint_name, user_name):
+                self._acquire(bucket, waiter)
+        except self._errors:
+            logger.exception('Redis limiter is unavailable')
+            self._fallback.acquire(endpoint_name, user_name)
+
+    def _acquire(self, bucket, waiter):
+        name, calls, period = bucket
+        keys = [f'{self.PREFIX}{name}']
+        if name == APP:
+            keys += [f'{self.PREFIX}queue', f'{self.PREFIX}seen']
+        ttl = int(period) + self.QUEUE_TIMEOUT
+
+        while True:
+            wait = float(self._take(keys=keys, args=[
+                calls, calls / period, ttl, waiter, self.QUEUE_TIMEOUT,
+            ]))
+            if wait <= 0:
+                return
+            time.sleep(min(wait, self.MAX_WAIT))
+
+
+_limiter = None
+
+
+def get_limiter():
+    """ Returns process-wide limiter by `settings.DEEZER_LIMITER_BACKEND`
+    """
+    global _limiter
+    if _limiter is None:
+        _limiter = _create_limiter(settings.DEEZER_LIMITER_BACKEND)
+    return _limiter
+
+
+def _create_limiter(backend):
+    quotas = Quotas(
+        calls=settings.DEEZER_QUOTA_CALLS,
+        period=settings.DEEZER_QUOTA_PERIOD,
+        user_calls=settings.DEEZER_USER_QUOTA_CALLS,
+        endpoint_calls={
+            name: int(calls)
+            for name, calls in settings.DEEZER_ENDPOINT_QUOTAS.items()
+        },
+    )
+    if backend == MEMORY:
+        return LocalLimiter(quotas)
+    if backend == REDIS:
+        return RedisLimiter(settings.DEEZER_LIMITER_REDIS_URL, quotas)
+    raise ValueError(f'unknown Deezer limiter backend: `{backend}`')
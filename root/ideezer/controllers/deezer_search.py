@@ -1,67 +1,236 @@
 import logging
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
 
 from .deezer_base import request
+from .deezer_cache import get_cache, make_key
+from .scoring import top
 from .. import models as md
 
 # https://developers.deezer.com/api/search
 
-SEARCH_URL = 'https://api.deezer.com/search'
+SEARCH_URL = f'{settings.DEEZER_API_URL}/search'
 LIMIT = 100
 
+# strategies of `combined` search
+SEQUENTIAL = 'sequential'
+EARLY_EXIT = 'early_exit'
+CONCURRENT = 'concurrent'
+# search clients of `matching`, see also `deezer_async.ASYNCIO`
+THREADS = 'threads'
+
 logger = logging.getLogger(__name__)
 
 
-def combined(track: md.UserTrack, token=None, one=False):
-    if track.s_album:
-        functions = advanced, advanced, simple, simple
-        album_flags = True, False, True, False
-    else:
-        functions = advanced, simple
-        album_flags = False, False
-
-    for function, album_flag in zip(functions, album_flags):
-        deezer_track = function(
-            track=track, token=token,
-            one=one, with_album=album_flag,
-        )
+def combined(track: md.UserTrack, token=None, one=False, strategy=None):
+    """ Searches `track` by advanced and simple queries with and without
+    album. Variants are requested by `strategy` (`SEQUENTIAL`, `EARLY_EXIT`
+    or `CONCURRENT`, `settings.DEEZER_SEARCH_STRATEGY` by default).
+
+    Result of the closest to `track` candidate is returned. Sequential
+    search stops at the first found candidate (so found track costs one or
+    two requests as before). Early exit search requests variants one by
+    one too, but stops only when diff of candidate is up to
+    `settings.SEARCH_GOOD_DIFF`; concurrent one requests all variants at
+    once and stops by the same diff.
+    """
+    if one:
+        # the track may be already matched by other user
+        deezer_track = md.DeezerMatch.lookup([track]).get(track)
         if deezer_track:
             return deezer_track
 
+    if md.DeezerMiss.missed([track]):
+        logger.debug('%s is known as missed', track)
+        return None
+
+    strategy = strategy or settings.DEEZER_SEARCH_STRATEGY
+    if strategy in (SEQUENTIAL, EARLY_EXIT):
+        responses = _request_sequentially(combined_queries(track), token)
+    elif strategy == CONCURRENT:
+        responses = _request_concurrently(combined_queries(track), token)
+    else:
+        raise ValueError(f'unknown Deezer search strategy: `{strategy}`')
+
+    best = None
+    with closing(responses):
+        for deezer_data in responses:
+            best = closest(track, best, deezer_data)
+            if is_enough(best, strategy):
+                break
+
+    if best is None:
+        # every search has no result
+        md.DeezerMiss.remember([track])
+        return None
+
+    deezer_data, track_info, _ = best
+    if one:
+        return md.DeezerTrack.from_deezer(track_info)
+    return _to_tracks(deezer_data)
+
+
+def closest(track: md.UserTrack, best, deezer_data):
+    """ Returns the closer to `track` of `best` and the closest candidate
+    of `deezer_data` as `(deezer_data, track_info, diff)` (`best` may be
+    None, `deezer_data` may be empty).
+    """
+    if not deezer_data:
+        return best
+    [(track_info, diff)] = top(track, deezer_data, 1)
+    if best is None or diff < best[2]:
+        return deezer_data, track_info, diff
+    return best
+
+
+def is_enough(best, strategy) -> bool:
+    """ Returns True, when `combined` search with `best` candidate stops
+    """
+    if best is None:
+        return False
+    return strategy == SEQUENTIAL or best[2] <= settings.SEARCH_GOOD_DIFF
+
+
+def combined_queries(track: md.UserTrack) -> list:
+    if track.s_album:
+        return [
+            advanced_query(track, with_album=True),
+            advanced_query(track, with_album=False),
+            simple_query(track, with_album=True),
+            simple_query(track, with_album=False),
+        ]
+    return [
+        advanced_query(track, with_album=False),
+        simple_query(track, with_album=False),
+    ]
+
+
+def _request_sequentially(queries, token=None):
+    for query in queries:
+        yield _request_search(query, token)
+
+
+def _request_concurrently(queries, token=None):
+    """ Requests all `queries` at once, responses are yielded as they are
+    completed. Not started requests are cancelled, when generator is closed.
+    """
+    executor = ThreadPoolExecutor(len(queries))
+    futures = [
+        executor.submit(_request_search, query, token) for query in queries
+    ]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
 
 def simple(
     track: md.UserTrack, with_album=True, token=None,
     limit=None, one=False
 ):
+    return _search(simple_query(track, with_album), token, limit, one, track)
+
+
+def simple_query(track: md.UserTrack, with_album=True) -> str:
     query = f'{track.s_artist} - {track.s_title}'
     if with_album and track.s_album:
         query = f'{query} {track.s_album}'
-    return _search(query, token, limit, one)
+    return query
 
 
 def advanced(
     track: md.UserTrack, with_album=True, token=None,
     limit=None, one=False
 ):
+    return _search(advanced_query(track, with_album), token, limit, one, track)
+
+
+def advanced_query(track: md.UserTrack, with_album=True) -> str:
     query = f'artist:"{track.s_artist}" track:"{track.s_title}"'
     if with_album and track.s_album:
         query = f'{query} album:"{track.s_album}"'
-    return _search(query, token, limit, one)
+    return query
+
+
+def search_top_responses(responses: dict, k) -> dict:
+    """ Scores Deezer responses `{track: deezer_data}` and saves top
+    candidates of all tracks together.
+
+    Returns dict `{track: [(deezer_track, diff), ...]}` with up to `k`
+    closest to track Deezer tracks ordered by diff.
+    """
+    scored = {
+        track: top(track, deezer_data, k)
+        for track, deezer_data in responses.items()
+    }
+    deezer_tracks = iter(md.DeezerTrack.from_deezer_many(
+        track_info
+        for candidates in scored.values() for track_info, _ in candidates
+    ))
+    return {
+        track: [(next(deezer_tracks), diff) for _, diff in candidates]
+        for track, candidates in scored.items()
+    }
 
 
-def _search(query, token=None, limit=None, one=False):
+def request_many(tracks, query=simple_query, token=None, limit=None) -> dict:
+    """ Searches `tracks` concurrently by `DEEZER_SEARCH_WORKERS` threads,
+    requests are limited by Deezer quota.
+
+    Returns Deezer responses `{track: deezer_data}`, failed searches
+    are logged and missed. Only HTTP requests are made by threads, Deezer
+    tracks are saved by the calling thread.
+    """
+    tracks = list(tracks)
+
+    def _request(track):
+        try:
+            return _request_search(query(track), token, limit)
+        except Exception:
+            logger.exception('search failed for %s', track)
+
+    with ThreadPoolExecutor(settings.DEEZER_SEARCH_WORKERS) as executor:
+        return {
+            track: deezer_data
+            for track, deezer_data in zip(tracks, executor.map(_request, tracks))
+            if deezer_data is not None
+        }
+
+
+def _search(query, token=None, limit=None, one=False, track=None):
+    return _to_tracks(_request_search(query, token, limit), one, track)
+
+
+def _request_search(query, token=None, limit=None) -> list:
     limit = limit or LIMIT
+    cache = get_cache()
+    cache_key = make_key(query, limit)
+    deezer_data = cache.get(cache_key)
+    if deezer_data is not None:
+        logger.debug("cached deezer response on '%s'", query)
+        return deezer_data
+
     params = {'q': query, 'limit': limit}
     if token:
         params['access_token'] = token
 
     deezer_data = request(SEARCH_URL, params)
     logger.debug("deezer response on '%s' with %s tracks", query, len(deezer_data))
+    cache.set(cache_key, deezer_data)
+    return deezer_data
+
+
+def _to_tracks(deezer_data, one=False, track=None):
     if one:
         if not deezer_data:
             return None
-        return md.DeezerTrack.from_deezer(deezer_data[0])
+        # the first Deezer suggestion, when there is nothing to compare
+        track_info = deezer_data[0]
+        if track:
+            [(track_info, _)] = top(track, deezer_data, 1)
+        return md.DeezerTrack.from_deezer(track_info)
 
-    return tuple(
-        md.DeezerTrack.from_deezer(track_info)
-        for track_info in deezer_data
-    )
+    return tuple(md.DeezerTrack.from_deezer_many(deezer_data))
@@ -0,0 +1,250 @@
+""" iTunes Library.xml readers.
+
+`StreamLibrary` walks the file with `iterparse` and drops every parsed
+track / playlist element right after it was yielded, so memory usage does not
+depend on the library size. `LegacyLibrary` keeps the old `libpytunes`
+behaviour (the whole plist is loaded in memory) and may be used as fallback.
+
+File may be compressed by gzip or zip, it is decompressed while reading.
+"""
+import gzip
+import logging
+import shutil
+import zipfile
+from base64 import b64decode
+from datetime import datetime
+from plistlib import InvalidFileException
+from tempfile import NamedTemporaryFile
+from typing import Iterator, NamedTuple, Optional, Tuple
+from xml.etree import ElementTree
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+STREAM = 'stream'
+LIBPYTUNES = 'libpytunes'
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+
+# the same playlists are ignored by `libpytunes.Library.getPlaylistNames`
+IGNORED_PLAYLISTS = (
+    'Library', 'Music', 'Movies', 'TV Shows', 'Purchased', 'iTunes DJ',
+    'Podcasts',
+)
+
+
+class ItunesTrack(NamedTuple):
+    track_id: int
+    persistent_id: Optional[str]
+    name: Optional[str]
+    artist: Optional[str]
+    album: Optional[str]
+
+
+class ItunesPlaylist(NamedTuple):
+    playlist_id: int
+    playlist_persistent_id: Optional[str]
+    name: str
+    is_folder: bool
+    distinguished_kind: Optional[int]
+    track_ids: Tuple[int, ...]
+
+
+def open_library(path, parser=None):
+    """ Returns library reader for iTunes xml file by `path`.
+
+    `parser` is one of `STREAM` or `LIBPYTUNES`,
+    `settings.ITUNES_XML_PARSER` is used by default.
+    """
+    parser = parser or settings.ITUNES_XML_PARSER
+    if parser == STREAM:
+        return StreamLibrary(path)
+    if parser == LIBPYTUNES:
+        return LegacyLibrary(path)
+    raise ValueError(f'unknown iTunes xml parser: `{parser}`')
+
+
+def file_suffix(head: bytes) -> str:
+    """ Returns file extension by the first bytes of iTunes xml file
+    """
+    if head.startswith(GZIP_MAGIC):
+        return '.xml.gz'
+    if head.startswith(ZIP_MAGIC):
+        return '.zip'
+    return '.xml'
+
+
+def is_compressed(path) -> bool:
+    with open(path, 'rb') as file:
+        return file_suffix(file.read(len(ZIP_MAGIC))) != '.xml'
+
+
+def open_xml(path):
+    """ Opens (probably compressed) iTunes xml file for streaming reading.
+
+    The first `.xml` file is read from zip archive.
+    """
+    with open(path, 'rb') as file:
+        suffix = file_suffix(file.read(len(ZIP_MAGIC)))
+
+    if suffix == '.xml.gz':
+        return gzip.open(path, 'rb')
+    if suffix == '.zip':
+        try:
+            with zipfile.ZipFile(path) as archive:
+                for name in archive.namelist():
+                    if name.lower().endswith('.xml') \
+                            and not name.startswith('__MACOSX/'):
+                        return archive.open(name)
+        except zipfile.BadZipFile as exc:
+            raise InvalidFileException() from exc
+        raise InvalidFileException()
+    return open(path, 'rb')
+
+
+class StreamLibrary:
+    def __init__(self, path):
+        self.path = path
+
+    def tracks(self) -> Iterator[ItunesTrack]:
+        for info in self._iter_section('Tracks', 'dict'):
+            yield _track_from_info(info)
+
+    def playlists(self) -> Iterator[ItunesPlaylist]:
+        for info in self._iter_section('Playlists', 'array'):
+            if info.get('Name') in IGNORED_PLAYLISTS:
+                continue
+            yield _playlist_from_info(info)
+
+    def _iter_section(self, section_name, section_tag):
+        """ Yields items of top-level `section_name` container one by one.
+
+        Layout of the file is:
+        <plist> <dict> <key>section</key> <section_tag> items... </...>
+        """
+        with open_xml(self.path) as file:
+            yield from self._iter_file(file, section_name, section_tag)
+
+    @staticmethod
+    def _iter_file(file, section_name, section_tag):
+        stack = []
+        section = None
+        try:
+            events = ElementTree.iterparse(file, events=('start', 'end'))
+            for event, elem in events:
+                if event == 'start':
+                    stack.append(elem)
+                    continue
+
+                stack.pop()
+                depth = len(stack)
+                if depth == 2 and elem.tag == 'key':
+                    section = elem.text
+                elif depth == 3 and elem.tag == 'dict':
+                    parent = stack[-1]
+                    if section == section_name and parent.tag == section_tag:
+                        yield _plist_value(elem)
+                    # item is not needed anymore: free it with neighbours
+                    parent.clear()
+                elif depth == 2:
+                    stack[-1].clear()
+                    if section == section_name:
+                        return
+        except (
+            ElementTree.ParseError, gzip.BadGzipFile, zipfile.BadZipFile,
+            EOFError,
+        ) as exc:
+            raise InvalidFileException() from exc
+
+        if not stack and section is None:
+            raise InvalidFileException()
+
+
+class LegacyLibrary:
+    def __init__(self, path):
+        from libpytunes import Library
+
+        if not is_compressed(path):
+            self._lib = Library(itunesxml=path)
+            return
+
+        # libpytunes reads files by path only
+        with open_xml(path) as src, NamedTemporaryFile(suffix='.xml') as tmp:
+            shutil.copyfileobj(src, tmp)
+            tmp.flush()
+            self._lib = Library(itunesxml=tmp.name)
+
+    def tracks(self) -> Iterator[ItunesTrack]:
+        for song in self._lib.songs.values():
+            yield ItunesTrack(
+                track_id=song.track_id,
+                persistent_id=song.persistent_id,
+                name=song.name,
+                artist=song.artist,
+                album=song.album,
+            )
+
+    def playlists(self) -> Iterator[ItunesPlaylist]:
+        for name in self._lib.getPlaylistNames(ignoreList=IGNORED_PLAYLISTS):
+            plst = self._lib.getPlaylist(name)
+            yield ItunesPlaylist(
+                playlist_id=plst.playlist_id,
+                playlist_persistent_id=plst.playlist_persistent_id,
+                name=plst.name,
+                is_folder=plst.is_folder,
+                distinguished_kind=plst.distinguished_kind,
+                track_ids=tuple(track.track_id for track in plst.tracks),
+            )
+
+
+def _track_from_info(info: dict) -> ItunesTrack:
+    return ItunesTrack(
+        track_id=info['Track ID'],
+        persistent_id=info.get('Persistent ID'),
+        name=info.get('Name'),
+        artist=info.get('Artist'),
+        album=info.get('Album'),
+    )
+
+
+def _playlist_from_info(info: dict) -> ItunesPlaylist:
+    return ItunesPlaylist(
+        playlist_id=info['Playlist ID'],
+        playlist_persistent_id=info.get('Playlist Persistent ID'),
+        name=info.get('Name'),
+        is_folder=info.get('Folder', False),
+        distinguished_kind=info.get('Distinguished Kind'),
+        track_ids=tuple(
+            item['Track ID'] for item in info.get('Playlist Items', ())
+        ),
+    )
+
+
+def _plist_value(elem):
+    tag = elem.tag
+    if tag == 'dict':
+        children = iter(elem)
+        return {
+            key.text: _plist_value(value)
+            for key, value in zip(children, children)
+        }
+    if tag == 'array':
+        return [_plist_value(child) for child in elem]
+    if tag == 'string':
+        return elem.text or ''
+    if tag == 'integer':
+        return int(elem.text)
+    if tag == 'real':
+        return float(elem.text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag == 'date':
+        return datetime.strptime(elem.text, '%Y-%m-%dT%H:%M:%SZ')
+    if tag == 'data':
+        return b64decode(elem.text or '')
+    raise InvalidFileException()
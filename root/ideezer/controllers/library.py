@@ -1,13 +1,21 @@
+import hashlib
 import logging
+import os
+from collections import defaultdict
+from itertools import chain, islice
 from typing import Tuple
 from tempfile import NamedTemporaryFile
 from plistlib import InvalidFileException
 
 from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from celery import states
 from celery.signals import task_success, task_prerun, task_failure
-from libpytunes import Library, Playlist
 
+from . import itunes_xml
+from .db_loader import chunked, get_loader
+from .pipeline import prefetch
 from ..celery_app import celery_app
 from .. import models as md
 from ..decorators.utils import timeit
@@ -17,19 +25,60 @@ logger = logging.getLogger(__name__)
 clogger = logging.getLogger('celery')
 PROCESS_ITUNES_LIBRARY = 'process_itunes_library'
 
+# import modes
+INCREMENTAL = 'incremental'
+FULL = 'full'
+RESUMABLE = 'resumable'
 
-def save(file, user, async_mode=True):
-    with NamedTemporaryFile(dir=settings.UPLOAD_PATH, delete=False) as tmp:
-        for chunk in file.chunks():
-            tmp.write(chunk)
+
+def save(file, user, async_mode=True) -> bool:
+    """ Stores uploaded file and starts its processing.
+
+    Returns False when the file is the same as the last imported one,
+    in this case processing is skipped.
+    """
+    path, content_hash = store_upload(file)
+
+    if content_hash == md.UploadHistory.last_imported_hash(user.id):
+        logger.info('library of %s is unchanged: %s', user, content_hash)
+        md.UploadHistory.create_unchanged(
+            user_id=user.id, content_hash=content_hash)
+        return False
 
     if not async_mode:
-        process(path=tmp.name, user_id=user.id)
-        return
+        process(path=path, user_id=user.id)
+        return True
 
     celery_app.send_task(PROCESS_ITUNES_LIBRARY, kwargs={
-        'path': tmp.name, 'user_id': user.id,
+        'path': path, 'user_id': user.id, 'content_hash': content_hash,
     })
+    return True
+
+
+def store_upload(file) -> Tuple[str, str]:
+    """ Writes uploaded file to `UPLOAD_PATH` under its sha256 hash.
+
+    Returns path to the file and the hash. Hash is calculated
+    while chunks are written, the same content is stored only once.
+    Compressed (gzip or zip) file is stored as is.
+    """
+    sha256 = hashlib.sha256()
+    suffix = None
+    with NamedTemporaryFile(dir=settings.UPLOAD_PATH, delete=False) as tmp:
+        for chunk in file.chunks():
+            if suffix is None:
+                suffix = itunes_xml.file_suffix(chunk)
+            sha256.update(chunk)
+            tmp.write(chunk)
+
+    content_hash = sha256.hexdigest()
+    path = os.path.join(
+        os.path.dirname(tmp.name), f'{content_hash}{suffix or ".xml"}')
+    if os.path.exists(path):
+        os.remove(tmp.name)
+    else:
+        os.replace(tmp.name, path)
+    return path, content_hash
 
 
 @task_prerun.connect
@@ -39,7 +88,10 @@ def library_upload_prerun_handler(task_id, task, *args, **kwargs):
 
     task.update_state(state=states.STARTED)
     task_kwargs = kwargs['kwargs']
-    md.UploadHistory.create(task_id=task_id, user_id=task_kwargs['user_id'])
+    md.UploadHistory.create(
+        task_id=task_id, user_id=task_kwargs['user_id'],
+        content_hash=task_kwargs.get('content_hash'),
+    )
 
 
 @task_success.connect
@@ -53,35 +105,149 @@ def library_upload_success_handler(result, sender, **kwargs):
         tracks_deleted=result['tracks_deleted'],
         playlists_created=result['playlists_created'],
         tracks_created=result['tracks_created'],
+        playlists_updated=result.get('playlists_updated'),
+        tracks_updated=result.get('tracks_updated'),
     )
 
 
 @task_failure.connect
 def library_upload_failure_handler(task_id, exception, *args, **kwargs):
-    if not isinstance(exception, InvalidFileException):
+    # the failure is final: only task of lost worker is redelivered
+    # (and it sends no failure)
+    md.ImportCheckpoint.release(task_id)
+    if isinstance(exception, InvalidFileException):
+        message = 'Invalid file'
+    elif isinstance(exception, md.ImportInProgress):
+        message = 'Other upload is in progress'
+    else:
         return
 
     history = md.UploadHistory.objects.get(task__task_id=task_id)
-    history.message = 'Invalid file'
+    history.message = message
     history.save()
 
 
-@celery_app.task(name=PROCESS_ITUNES_LIBRARY)
-def process(path, user_id) -> dict:
+# `acks_late` with `reject_on_worker_lost` make broker redeliver the task,
+# when worker dies; resumable import continues from the last checkpoint then
+@celery_app.task(
+    name=PROCESS_ITUNES_LIBRARY, acks_late=True, reject_on_worker_lost=True,
+)
+def process(
+    path, user_id, parser=None, mode=None, content_hash=None,
+) -> dict:
+    """ Imports iTunes library for user.
+
+    Modes are:
+    * `INCREMENTAL`: only changed tracks and playlists are touched,
+    so Deezer pairs of unchanged tracks survive re-import;
+    * `FULL`: all user data is removed and inserted again;
+    * `RESUMABLE`: as `FULL`, but data is committed by chunks with
+    checkpoints, so retried task continues from the last committed chunk.
+
+    `settings.ITUNES_IMPORT_MODE` is used by default.
+
+    `content_hash` is not used here and stored to `UploadHistory`
+    by `library_upload_prerun_handler`.
+    """
     clogger.info('process file: %s for user %s', path, user_id)
+    mode = mode or settings.ITUNES_IMPORT_MODE
 
     # no need for try-except because
     # on any Exception celery task will be marked as failed
-    lib = Library(itunesxml=path)
-    playlist_deleted, track_delete = clear_user_itunes_data(user_id)
-    insert_tracks(lib, user_id)
-    playlists_created = insert_playlists(lib, user_id)
+    lib = itunes_xml.open_library(path, parser=parser)
+    if mode == RESUMABLE:
+        return process_resumable(lib, user_id, task_id=process.request.id)
+    if mode not in (INCREMENTAL, FULL):
+        raise ValueError(f'unknown import mode: `{mode}`')
+
+    # file is parsed while inserting, so old data is removed in the same
+    # transaction to keep it untouched for invalid file
+    with transaction.atomic():
+        if mode == INCREMENTAL:
+            tracks_created, tracks_updated, track_delete = (
+                sync_tracks(lib, user_id))
+            playlists_created, playlists_updated, playlist_deleted = (
+                sync_playlists(lib, user_id))
+        else:
+            playlist_deleted, track_delete = clear_user_itunes_data(user_id)
+            tracks_created = insert_tracks(lib, user_id)
+            playlists_created = insert_playlists(lib, user_id)
+            tracks_updated = playlists_updated = 0
 
     return dict(
         playlists_deleted=playlist_deleted,
         tracks_deleted=track_delete,
         playlists_created=playlists_created,
-        tracks_created=len(lib.songs.values()),
+        tracks_created=tracks_created,
+        playlists_updated=playlists_updated,
+        tracks_updated=tracks_updated,
+    )
+
+
+@timeit(clogger)
+def process_resumable(lib, user_id, task_id) -> dict:
+    checkpoint = md.ImportCheckpoint.start(user_id=user_id, task_id=task_id)
+    if checkpoint.phase != checkpoint.CLEAR:
+        clogger.info('resume import for user %s from `%s` phase, item %s',
+                     user_id, checkpoint.phase, checkpoint.position)
+
+    loader = get_loader()
+    chunks = None
+    if checkpoint.phase == checkpoint.CLEAR:
+        # the first chunk is parsed before old data is removed and inserted
+        # in the same transaction, so old data is kept for invalid file
+        chunks = prefetch(
+            parse_tracks(lib, user_id), settings.IMPORT_QUEUE_SIZE)
+        chunk = next(chunks, [])
+        with transaction.atomic():
+            playlists_deleted, tracks_deleted = clear_user_itunes_data(user_id)
+            loader.insert(md.UserTrack, chunk)
+            checkpoint.commit(
+                phase=checkpoint.TRACKS, position=len(chunk),
+                tracks_created=len(chunk),
+                playlists_deleted=playlists_deleted,
+                tracks_deleted=tracks_deleted,
+            )
+
+    if checkpoint.phase == checkpoint.TRACKS:
+        if chunks is None:
+            chunks = prefetch(
+                parse_tracks(lib, user_id, skip=checkpoint.position),
+                settings.IMPORT_QUEUE_SIZE,
+            )
+        for chunk in chunks:
+            with transaction.atomic():
+                loader.insert(md.UserTrack, chunk)
+                checkpoint.commit(
+                    position=checkpoint.position + len(chunk),
+                    tracks_created=checkpoint.tracks_created + len(chunk),
+                )
+        checkpoint.commit(phase=checkpoint.PLAYLISTS, position=0)
+
+    if checkpoint.phase == checkpoint.PLAYLISTS:
+        track_ids = dict(md.UserTrack.objects.by_user(
+            user_id).values_list('itunes_id', 'id'))
+        chunks = prefetch(
+            parse_playlists(lib, skip=checkpoint.position),
+            settings.IMPORT_QUEUE_SIZE,
+        )
+        for chunk in chunks:
+            with transaction.atomic():
+                created_cnt = bulk_create_playlists(chunk, user_id, track_ids)
+                checkpoint.commit(
+                    position=checkpoint.position + len(chunk),
+                    playlists_created=(
+                        checkpoint.playlists_created + created_cnt),
+                )
+        checkpoint.commit(phase=checkpoint.DONE, position=0)
+
+    return dict(
+        playlists_deleted=checkpoint.playlists_deleted,
+        tracks_deleted=checkpoint.tracks_deleted,
+        playlists_created=checkpoint.playlists_created,
+        tracks_created=checkpoint.tracks_created,
+        playlists_updated=0,
+        tracks_updated=0,
     )
 
 
@@ -95,39 +261,301 @@ def clear_user_itunes_data(user_id) -> Tuple[int, int]:
     )
 
 
+# Import is pipelined: file is parsed by background thread (parse stage),
+# while database is written by the task thread (write stage). Stages are
+# connected by queue of IMPORT_QUEUE_SIZE chunks.
+
+@timeit(clogger)
+def insert_tracks(lib, user_id) -> int:
+    chunks = prefetch(parse_tracks(lib, user_id), settings.IMPORT_QUEUE_SIZE)
+    return write_tracks(chunks)
+
+
 @timeit(clogger)
-def insert_tracks(lib, user_id):
+def parse_tracks(lib, user_id, skip=0):
+    """ Yields chunks of new tracks, the first `skip` tracks are ignored.
+    """
     tracks = (
         md.UserTrack.from_itunes(track, user_id)
-        for track in lib.songs.values()
+        for track in islice(lib.tracks(), skip, None)
     )
-    md.UserTrack.objects.bulk_create(tracks)
+    yield from chunked(tracks, settings.IMPORT_BATCH_SIZE)
+
+
+@timeit(clogger)
+def write_tracks(chunks) -> int:
+    return get_loader().insert(md.UserTrack, chain.from_iterable(chunks))
 
 
 @timeit(clogger)
 def insert_playlists(lib, user_id) -> int:
-    tracks_cache = {
-        track.itunes_id: track
-        for track in md.UserTrack.objects.by_user(user_id)
-    }
+    chunks = prefetch(parse_playlists(lib), settings.IMPORT_QUEUE_SIZE)
+    return write_playlists(chunks, user_id)
+
+
+@timeit(clogger)
+def parse_playlists(lib, skip=0):
+    """ Yields chunks of playlists to create,
+    the first `skip` playlists are ignored.
+    """
+    playlists = (
+        plst for plst in lib.playlists() if not _skip_playlist(plst, log=True)
+    )
+    yield from chunked(
+        islice(playlists, skip, None), settings.IMPORT_BATCH_SIZE)
+
+
+@timeit(clogger)
+def write_playlists(chunks, user_id) -> int:
+    track_ids = dict(
+        md.UserTrack.objects.by_user(user_id).values_list('itunes_id', 'id')
+    )
 
     created_cnt = 0
-    for idx, plst_name in enumerate(lib.getPlaylistNames(), start=1):
-        plst: Playlist = lib.getPlaylist(plst_name)
-        if plst.is_folder or plst.distinguished_kind:
-            clogger.info(
-                'skip `%s` because is_folder = %s, distinguished_kind = %s',
-                plst_name, plst.is_folder, plst.distinguished_kind)
+    for chunk in chunks:
+        created_cnt += bulk_create_playlists(chunk, user_id, track_ids)
+        clogger.info('playlists created: %s', created_cnt)
+    return created_cnt
+
+
+def bulk_create_playlists(plsts, user_id, track_ids) -> int:
+    """ Creates playlists with their content by a few queries.
+
+    `track_ids` maps iTunes track id to `UserTrack.id` of user tracks.
+    """
+    md.Playlist.objects.bulk_create(
+        md.Playlist.from_itunes(plst, user_id) for plst in plsts
+    )
+    # pk is not set by `bulk_create` for all databases
+    playlist_ids = dict(md.Playlist.objects.by_user(user_id).filter(
+        itunes_id__in=[plst.playlist_id for plst in plsts],
+    ).values_list('itunes_id', 'id'))
+
+    bulk_add_content(
+        (playlist_ids[plst.playlist_id], track_ids[track_id])
+        for plst in plsts
+        for track_id in set(plst.track_ids)
+    )
+    md.Playlist.check_content_owner(playlist_ids.values())
+    return len(plsts)
+
+
+def bulk_add_content(pairs):
+    """ Inserts `(playlist_id, usertrack_id)` pairs into playlists content.
+    """
+    through = md.Playlist.itunes_content.through
+    get_loader().insert(through, (
+        through(playlist_id=playlist_id, usertrack_id=usertrack_id)
+        for playlist_id, usertrack_id in pairs
+    ))
+
+
+def _skip_playlist(plst, log=False) -> bool:
+    skip = bool(plst.is_folder or plst.distinguished_kind)
+    if skip and log:
+        clogger.info(
+            'skip `%s` because is_folder = %s, distinguished_kind = %s',
+            plst.name, plst.is_folder, plst.distinguished_kind)
+    return skip
+
+
+class _RowMatcher:
+    """ Matches items from iTunes xml to exists rows.
+
+    Row is matched by `persistent_id` first and by `itunes_id` for rows
+    without persistent id (or items without it). Every row may be matched
+    only once.
+    """
+    def __init__(self, rows):
+        self.itunes_ids = {}
+        self.by_persistent_id = {}
+        self.by_itunes_id = {}
+        for pk, itunes_id, persistent_id in rows:
+            self.itunes_ids[pk] = itunes_id
+            self.by_itunes_id[itunes_id] = (pk, persistent_id)
+            if persistent_id:
+                self.by_persistent_id[persistent_id] = pk
+        self.matched = {}  # pk -> new itunes_id
+
+    def match(self, itunes_id, persistent_id):
+        pk = self.by_persistent_id.get(persistent_id)
+        if pk is None and itunes_id in self.by_itunes_id:
+            row_pk, row_persistent_id = self.by_itunes_id[itunes_id]
+            if not row_persistent_id or not persistent_id:
+                pk = row_pk
+
+        if pk is None or pk in self.matched:
+            return None
+        self.matched[pk] = itunes_id
+        return pk
+
+    @property
+    def unmatched(self):
+        return [pk for pk in self.itunes_ids if pk not in self.matched]
+
+    @property
+    def moved(self):
+        """ Matched rows with changed `itunes_id`
+        """
+        return [
+            pk for pk, itunes_id in self.matched.items()
+            if self.itunes_ids[pk] != itunes_id
+        ]
+
+
+def _delete_rows(queryset, pks) -> int:
+    deleted_cnt = 0
+    for chunk in chunked(pks, settings.IMPORT_BATCH_SIZE):
+        _, info = queryset.filter(pk__in=chunk).delete()
+        deleted_cnt += info.get(queryset.model._meta.label, 0)
+    return deleted_cnt
+
+
+def _release_itunes_ids(queryset, pks):
+    """ Temporary set negative `itunes_id` (unused by iTunes) for rows,
+    which `itunes_id` is going to change: new ids may be swapped between
+    rows, so unique constraint must not be violated while updating.
+    """
+    for chunk in chunked(pks, settings.IMPORT_BATCH_SIZE):
+        queryset.filter(pk__in=chunk).update(itunes_id=-F('id'))
+
+
+TRACK_ITUNES_FIELDS = (
+    'itunes_id', 'itunes_persistent_id', 'title', 'artist', 'album',
+)
+# tracks are searched in Deezer by these fields
+TRACK_SEARCH_FIELDS = ('title', 'artist', 'album')
+PLAYLIST_ITUNES_FIELDS = (
+    'itunes_id', 'itunes_persistent_id', 'itunes_title',
+)
+
+
+def _changed(obj, new_obj, fields) -> bool:
+    return any(
+        getattr(obj, field) != getattr(new_obj, field) for field in fields
+    )
+
+
+@timeit(clogger)
+def sync_tracks(lib, user_id) -> Tuple[int, int, int]:
+    """ Returns created, updated and deleted tracks count. Deezer pairs of
+    tracks with changed search fields are deleted, so they are searched
+    again.
+    """
+    queryset = md.UserTrack.objects.by_user(user_id)
+    matcher = _RowMatcher(queryset.values_list(
+        'id', 'itunes_id', 'itunes_persistent_id'))
+    # the first pass over file to find out which rows are gone
+    pairs = {
+        track.track_id: matcher.match(track.track_id, track.persistent_id)
+        for track in lib.tracks()
+    }
+    deleted_cnt = _delete_rows(queryset, matcher.unmatched)
+    _release_itunes_ids(queryset, matcher.moved)
+
+    loader = get_loader()
+    chunks = prefetch(
+        chunked(lib.tracks(), settings.IMPORT_BATCH_SIZE),
+        settings.IMPORT_QUEUE_SIZE,
+    )
+    created_cnt = updated_cnt = 0
+    for chunk in chunks:
+        current = queryset.in_bulk([
+            pairs[track.track_id] for track in chunk
+            if pairs[track.track_id]
+        ])
+
+        created, updated, renamed = [], [], []
+        for track in chunk:
+            obj = md.UserTrack.from_itunes(track, user_id)
+            obj.pk = pairs[track.track_id]
+            if obj.pk is None:
+                created.append(obj)
+            elif _changed(current[obj.pk], obj, TRACK_ITUNES_FIELDS):
+                updated.append(obj)
+                if _changed(current[obj.pk], obj, TRACK_SEARCH_FIELDS):
+                    renamed.append(obj.pk)
+
+        loader.insert(md.UserTrack, created)
+        md.UserTrack.objects.bulk_update(updated, TRACK_ITUNES_FIELDS)
+        md.TrackIdentity.objects.filter(user_track_id__in=renamed).delete()
+        created_cnt += len(created)
+        updated_cnt += len(updated)
+
+    return created_cnt, updated_cnt, deleted_cnt
+
+
+@timeit(clogger)
+def sync_playlists(lib, user_id) -> Tuple[int, int, int]:
+    """ Returns created, updated and deleted playlists count. Existing
+    playlists and their content are loaded by two queries, changes are
+    written by chunks, so queries count does not grow with playlists.
+    """
+    queryset = md.Playlist.objects.by_user(user_id)
+    matcher = _RowMatcher(queryset.values_list(
+        'id', 'itunes_id', 'itunes_persistent_id'))
+    pairs = {
+        plst.playlist_id: matcher.match(
+            plst.playlist_id, plst.playlist_persistent_id)
+        for plst in lib.playlists() if not _skip_playlist(plst)
+    }
+    deleted_cnt = _delete_rows(queryset, matcher.unmatched)
+    _release_itunes_ids(queryset, matcher.moved)
+
+    track_ids = dict(
+        md.UserTrack.objects.by_user(user_id).values_list('itunes_id', 'id')
+    )
+    through = md.Playlist.itunes_content.through
+    playlists = queryset.in_bulk(list(matcher.matched))
+    # {playlist_id: {usertrack_id: through row id}}
+    contents = defaultdict(dict)
+    for row_id, playlist_id, usertrack_id in through.objects.filter(
+        playlist__user_id=user_id,
+    ).values_list('id', 'playlist_id', 'usertrack_id'):
+        contents[playlist_id][usertrack_id] = row_id
+
+    created, created_cnt = [], 0
+    updated, removed_rows, added = [], [], []
+    updated_cnt = 0
+    for plst in lib.playlists():
+        if _skip_playlist(plst, log=True):
             continue
 
-        playlist = md.Playlist.from_itunes(plst, user_id)
-        playlist.save()
+        pk = pairs[plst.playlist_id]
+        if pk is None:
+            created.append(plst)
+            if len(created) == settings.IMPORT_BATCH_SIZE:
+                created_cnt += bulk_create_playlists(created, user_id, track_ids)
+                created = []
+            continue
 
-        content = [tracks_cache[track.track_id] for track in plst.tracks]
-        playlist.itunes_content.add(*content)
-        playlist.save()
-        created_cnt += 1
+        new_playlist = md.Playlist.from_itunes(plst, user_id)
+        new_playlist.pk = pk
+        changed = _changed(playlists[pk], new_playlist, PLAYLIST_ITUNES_FIELDS)
+        if changed:
+            updated.append(new_playlist)
 
-        if idx % 10 == 0:
-            clogger.info('iter: %s', idx)
-    return created_cnt
+        content = {track_ids[track_id] for track_id in plst.track_ids}
+        exists = contents[pk]
+        if exists.keys() != content:
+            removed_rows.extend(
+                row_id for track_id, row_id in exists.items()
+                if track_id not in content
+            )
+            added.extend(
+                (pk, track_id) for track_id in content - exists.keys()
+            )
+            changed = True
+
+        if changed:
+            updated_cnt += 1
+
+    if created:
+        created_cnt += bulk_create_playlists(created, user_id, track_ids)
+    md.Playlist.objects.bulk_update(
+        updated, PLAYLIST_ITUNES_FIELDS, batch_size=settings.IMPORT_BATCH_SIZE,
+    )
+    _delete_rows(through.objects.all(), removed_rows)
+    bulk_add_content(added)
+
+    return created_cnt, updated_cnt, deleted_cnt
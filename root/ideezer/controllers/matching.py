@@ -0,0 +1,433 @@
+import logging
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from django.conf import settings
+from celery import states
+from celery.signals import task_prerun
+
+from . import deezer_album, deezer_async, deezer_quota, deezer_search
+from .deezer_base import get_breaker
+from .deezer_breaker import CLOSED
+from .db_loader import chunked
+from .scoring import top
+from ..celery_app import celery_app
+from .. import models as md
+
+
+logger = logging.getLogger(__name__)
+clogger = logging.getLogger('celery')
+SEARCH_PLAYLIST = 'search_playlist'
+SEARCH_LIBRARY = 'search_library'
+
+
+def start_playlist_search(playlist, user) -> bool:
+    """ Starts search of playlist tracks.
+
+    Returns False, when the playlist is searched already: search is not
+    started again.
+    """
+    try:
+        history = md.SearchHistory.create_pending(
+            user_id=user.id, playlist_id=playlist.id,
+        )
+    except md.SearchInProgress:
+        logger.info('playlist %s is searched already', playlist.id)
+        return False
+
+    celery_app.send_task(
+        SEARCH_PLAYLIST, task_id=history.task.task_id,
+        kwargs={'playlist_id': playlist.id, 'user_id': user.id},
+    )
+    return True
+
+
+def start_library_search(user):
+    celery_app.send_task(SEARCH_LIBRARY, kwargs={'user_id': user.id})
+
+
+@task_prerun.connect
+def search_prerun_handler(task_id, task, *args, **kwargs):
+    if task.name not in (SEARCH_PLAYLIST, SEARCH_LIBRARY):
+        return
+
+    task.update_state(state=states.STARTED)
+    task_kwargs = kwargs['kwargs']
+    md.SearchHistory.create(
+        task_id=task_id, user_id=task_kwargs['user_id'],
+        playlist_id=task_kwargs.get('playlist_id'),
+    )
+
+
+@celery_app.task(name=SEARCH_PLAYLIST)
+def search_playlist(playlist_id, user_id) -> dict:
+    clogger.info('search playlist %s for user %s', playlist_id, user_id)
+    playlist = md.Playlist.objects.get(pk=playlist_id, user_id=user_id)
+    return search_playlist_tracks(playlist, _task_history(search_playlist))
+
+
+@celery_app.task(name=SEARCH_LIBRARY)
+def search_library(user_id) -> dict:
+    clogger.info('search library for user %s', user_id)
+    return search_library_tracks(user_id, _task_history(search_library))
+
+
+def _task_history(task):
+    return md.SearchHistory.objects.filter(
+        task__task_id=task.request.id,
+    ).first()
+
+
+def search_playlist_tracks(playlist: md.Playlist, history=None) -> dict:
+    """ Searches Deezer pairs for playlist tracks without them.
+    """
+    return search_unpaired(playlist.itunes_content.all(), history)
+
+
+def search_library_tracks(user_id, history=None) -> dict:
+    """ Searches Deezer pairs for all user tracks without them. Every
+    track is searched once, however many playlists contain it.
+    """
+    return search_unpaired(md.UserTrack.objects.by_user(user_id), history)
+
+
+def search_unpaired(user_tracks, history=None) -> dict:
+    """ Searches Deezer pairs for tracks from `user_tracks` queryset,
+    which have no chosen pair.
+
+    Tracks are searched by `SEARCH_CHUNK_SIZE` chunks, progress is saved
+    to `history` (if any) after every chunk. Pairs are taken from shared
+    `DeezerMatch` index first, the rest tracks are searched by Deezer API
+    (except `DeezerMiss` ones, which were not found before). Requests of
+    chunk are limited by Deezer quota, so the whole library is searched in
+    one pass. With asyncio client (`DEEZER_SEARCH_CLIENT`) the next chunks
+    are searched, while results of the previous one are saved. The closest
+    of `SEARCH_TOP_K` kept candidates is chosen.
+
+    Tracks not found by simple query are searched by the other
+    `combined_queries` and remembered as `DeezerMiss`, when nothing is
+    found. Tracks with the same search key (duplicates) are searched once,
+    pairs are created for all of them.
+
+    When `SEARCH_BY_ALBUM` is set, tracks of the same album are paired
+    with Deezer album tracks first (see `search_albums`).
+    """
+    md.TrackIdentity.mark_exists_tracks_as_pairs(user_tracks)
+    unpaired = user_tracks.exclude(trackidentity__chosen=True).distinct()
+    progress = dict(
+        total=unpaired.count(), done=0, matched=0, failed=0, indexed=0,
+    )
+    if history:
+        history.update_progress(**progress)
+
+    paired = set()
+    if settings.SEARCH_BY_ALBUM:
+        paired = search_albums(unpaired, progress, history)
+    duplicates = _group_duplicates(unpaired, exclude=paired)
+
+    with _searcher() as request_many:
+        pending = deque()
+        for chunk_ids in chunked(duplicates, settings.SEARCH_CHUNK_SIZE):
+            pending.append(_start_chunk(chunk_ids, request_many))
+            if len(pending) > _chunks_ahead():
+                _save_chunk(
+                    request_many, *pending.popleft(), progress, history)
+        while pending:
+            _save_chunk(request_many, *pending.popleft(), progress, history)
+
+    clogger.info('search result: %s', progress)
+    return progress
+
+
+def _start_chunk(chunk_ids, request_many) -> tuple:
+    """ Takes pairs of chunk tracks from index and starts search of the
+    rest tracks. Returns arguments of `_save_chunk`.
+    """
+    saved = md.UserTrack.objects.in_bulk(
+        [pk for group_ids in chunk_ids for pk in group_ids],
+    )
+    # the first track of group is searched for the whole group
+    groups = {}
+    for group_ids in chunk_ids:
+        group = [saved[pk] for pk in group_ids if pk in saved]
+        if group:
+            groups[group[0]] = group
+    chunk = list(groups)
+
+    indexed = md.DeezerMatch.lookup(chunk)
+    missed = md.DeezerMiss.missed(
+        track for track in chunk if track not in indexed
+    )
+    searched = [
+        track for track in chunk
+        if track not in indexed and track not in missed
+    ]
+    return groups, indexed, searched, _request_available(request_many, searched)
+
+
+def _save_chunk(
+    request_many, groups, indexed, searched, responses, progress, history,
+):
+    """ Waits for chunk `responses` and saves pairs of chunk tracks.
+    Tracks not found by any of `combined_queries` are remembered as missed.
+    """
+    responses = responses.result()
+    _search_variants(request_many, responses)
+    found = deezer_search.search_top_responses(
+        responses, settings.SEARCH_TOP_K,
+    )
+    # duplicates have the same search key, so the group is remembered
+    md.DeezerMiss.remember(
+        track for track, candidates in found.items() if not candidates
+    )
+    identities = _identities(_fan_out(groups, {
+        track: [(deezer_track, None)]
+        for track, deezer_track in indexed.items()
+    }))
+    searched_identities = _identities(_fan_out(groups, found))
+    _save_identities(identities)
+    md.DeezerMatch.record(_save_identities(searched_identities))
+
+    progress['done'] += _size(groups, groups)
+    progress['matched'] += _size(groups, indexed) + _size(
+        groups, [track for track, candidates in found.items() if candidates],
+    )
+    progress['failed'] += _size(groups, [
+        track for track in searched if track not in found
+    ])
+    progress['indexed'] += _size(groups, indexed)
+    if history:
+        history.update_progress(**progress)
+
+
+def search_albums(user_tracks, progress: dict, history=None) -> set:
+    """ Groups `user_tracks` by artist and album and pairs them with tracks
+    of the closest Deezer album, so album of `ALBUM_MIN_TRACKS` tracks or
+    more takes two Deezer requests. Tracks from `DeezerMatch` index and
+    `DeezerMiss` ones are not counted (they take no requests). Pairs with
+    diff over `ALBUM_MATCH_MAX_DIFF` are rejected (such tracks are left for
+    per-track search).
+
+    Updates `progress` and returns ids of paired tracks.
+    """
+    albums = defaultdict(list)
+    for track in user_tracks:
+        if track.s_album:
+            albums[_album_key(track)].append(track)
+
+    known = set()
+    for chunk in chunked(
+        (
+            track for tracks in albums.values()
+            if len(tracks) >= settings.ALBUM_MIN_TRACKS for track in tracks
+        ),
+        settings.SEARCH_CHUNK_SIZE,
+    ):
+        known |= md.DeezerMatch.indexed(chunk) | md.DeezerMiss.missed(chunk)
+
+    paired = set()
+    for tracks in albums.values():
+        tracks = [track for track in tracks if track not in known]
+        if len(tracks) < settings.ALBUM_MIN_TRACKS:
+            continue
+        _wait_deezer(deezer_album.SEARCH_URL)
+        try:
+            album_tracks = deezer_album.search_tracks(
+                tracks[0].s_artist, tracks[0].s_album,
+            )
+        except Exception:
+            logger.exception('album search failed for %s', tracks[0])
+            continue
+
+        scored = {}
+        for track in tracks:
+            candidates = top(track, album_tracks, 1)
+            if candidates \
+                    and candidates[0][1] <= settings.ALBUM_MATCH_MAX_DIFF:
+                scored[track] = candidates[0]
+        deezer_tracks = md.DeezerTrack.from_deezer_many(
+            track_info for track_info, _ in scored.values()
+        )
+        identities = _identities({
+            track: [(deezer_track, diff)]
+            for (track, (_, diff)), deezer_track
+            in zip(scored.items(), deezer_tracks)
+        })
+        md.DeezerMatch.record(_save_identities(identities))
+
+        paired.update(track.pk for track in scored)
+        progress['done'] += len(scored)
+        progress['matched'] += len(scored)
+        if history and scored:
+            history.update_progress(**progress)
+    return paired
+
+
+def _album_key(track: md.UserTrack) -> tuple:
+    return tuple(
+        ' '.join((value or '').lower().split())
+        for value in (track.s_artist, track.s_album)
+    )
+
+
+def _wait_deezer(url):
+    """ Pauses job while Deezer API endpoint of `url` is unavailable
+    """
+    get_breaker().wait(deezer_quota.endpoint(url))
+
+
+def _request_available(
+    request_many, tracks, query=deezer_search.simple_query,
+) -> Future:
+    """ `request_many`, which pauses while Deezer search is unavailable.
+    While circuit is half-open, tracks are requested one by one (the first
+    one is the probe), so the rest of chunk does not fail at once.
+    """
+    breaker = get_breaker()
+    endpoint = deezer_quota.endpoint(deezer_search.SEARCH_URL)
+    responses = {}
+    while tracks:
+        breaker.wait(endpoint)
+        if breaker.state(endpoint) == CLOSED:
+            if not responses:
+                return request_many(tracks, query)
+            responses.update(request_many(tracks, query).result())
+            break
+        responses.update(request_many(tracks[:1], query).result())
+        tracks = tracks[1:]
+    return _done(responses)
+
+
+def _search_variants(request_many, responses: dict):
+    """ Searches tracks of `responses` not found by simple query by the
+    rest of `combined_queries`, one variant of every track at a time, until
+    it is found. Updates `responses`, failed searches are removed.
+    """
+    variants = {
+        track: [
+            query for query in deezer_search.combined_queries(track)
+            if query != deezer_search.simple_query(track)
+        ]
+        for track, deezer_data in responses.items() if not deezer_data
+    }
+    while variants:
+        found = _request_available(
+            request_many, list(variants), lambda track: variants[track][0],
+        ).result()
+        for track in list(variants):
+            deezer_data = found.get(track)
+            queries = variants.pop(track)[1:]
+            if deezer_data is None:
+                # failed, the track is not known as missed
+                del responses[track]
+                continue
+            responses[track] = deezer_data
+            if not deezer_data and queries:
+                variants[track] = queries
+
+
+@contextmanager
+def _searcher():
+    """ Yields `request_many(tracks, query)` of
+    `settings.DEEZER_SEARCH_CLIENT`, which returns future of Deezer
+    responses `{track: deezer_data}`
+    """
+    client = settings.DEEZER_SEARCH_CLIENT
+    if client == deezer_search.THREADS:
+        yield lambda tracks, query=deezer_search.simple_query: _done(
+            deezer_search.request_many(tracks, query))
+    elif client == deezer_async.ASYNCIO:
+        with deezer_async.Searcher() as searcher:
+            yield searcher.request_many
+    else:
+        raise ValueError(f'unknown Deezer search client: `{client}`')
+
+
+def _chunks_ahead() -> int:
+    """ Returns count of chunks searched, while the previous one is saved:
+    asyncio client keeps `DEEZER_ASYNC_CONNECTIONS` searches in flight
+    """
+    if settings.DEEZER_SEARCH_CLIENT == deezer_async.ASYNCIO:
+        return max(
+            1, settings.DEEZER_ASYNC_CONNECTIONS // settings.SEARCH_CHUNK_SIZE,
+        )
+    return 0
+
+
+def _done(result) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def _group_duplicates(user_tracks, exclude=()) -> list:
+    """ Returns ids of `user_tracks` grouped by search key
+    """
+    groups = defaultdict(list)
+    for track in user_tracks.only(
+        'title', 'artist', 'album', '_s_title', '_s_artist', '_s_album',
+    ).order_by('pk'):
+        if track.pk not in exclude:
+            groups[track.search_key].append(track.pk)
+    return list(groups.values())
+
+
+def _size(groups: dict, tracks) -> int:
+    """ Returns count of tracks in groups of `tracks`
+    """
+    return sum(len(groups[track]) for track in tracks)
+
+
+def _fan_out(groups: dict, found: dict) -> dict:
+    """ Returns result of group track for every track of group.
+    Diffs of group track are kept.
+    """
+    return {
+        track: candidates
+        for group_track, candidates in found.items()
+        for track in groups[group_track]
+    }
+
+
+def _save_identities(identities) -> list:
+    """ Inserts `identities` and returns inserted ones. Tracks, which are
+    paired meanwhile (e.g. by other search), are skipped, as well as
+    existing pairs.
+    """
+    paired = set()
+    for chunk in chunked(
+        {identity.user_track_id for identity in identities},
+        settings.SEARCH_CHUNK_SIZE,
+    ):
+        paired.update(md.TrackIdentity.objects.filter(
+            user_track_id__in=chunk, chosen=True,
+        ).values_list('user_track_id', flat=True))
+    identities = [
+        identity for identity in identities
+        if identity.user_track_id not in paired
+    ]
+    md.TrackIdentity.objects.bulk_create(identities, ignore_conflicts=True)
+    return identities
+
+
+def _identities(found: dict) -> list:
+    """ Returns identities by `{track: [(deezer_track, diff), ...]}`,
+    the first candidate of track is chosen. Diff is calculated, when it
+    is None.
+    """
+    identities = []
+    for track, candidates in found.items():
+        paired = set()
+        for deezer_track, diff in candidates:
+            if deezer_track.pk in paired:
+                continue
+            paired.add(deezer_track.pk)
+            ti = md.TrackIdentity(
+                user_track=track, deezer_track=deezer_track,
+                chosen=True if len(paired) == 1 else None, diff=diff,
+            )
+            if diff is None:
+                ti.set_diff()
+            identities.append(ti)
+    return identities
@@ -0,0 +1,67 @@
+""" Producer-consumer helpers for import stages.
+
+Items of producer iterable are calculated in background thread and passed
+to consumer through bounded queue, so producer may be at most `maxsize`
+items ahead of consumer.
+"""
+import logging
+import threading
+from queue import Queue, Full
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+_PUT_TIMEOUT = 0.1
+
+
+class _Error:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+def prefetch(iterable, maxsize):
+    """ Yields items of `iterable`, which is consumed by background thread.
+
+    Exception raised by `iterable` is re-raised in consumer thread.
+    Background thread stops, when consumer stops iteration.
+    """
+    queue = Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def _put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_PUT_TIMEOUT)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put(item):
+                    break
+            else:
+                _put(_DONE)
+        except Exception as exc:
+            _put(_Error(exc))
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Error):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+        thread.join()
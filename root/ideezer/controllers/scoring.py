@@ -0,0 +1,49 @@
+""" Scoring of Deezer search candidates for iTunes track.
+
+Diff of candidate is the same as `TrackIdentity.set_diff` one: sum of
+Levenshtein distances of artist, title and album (album is compared only
+when track has it). Every attribute of all candidates is compared by the
+single `rapidfuzz.process.extract` call.
+"""
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein
+
+from .. import models as md
+
+
+def info_attrs(track_info: dict) -> tuple:
+    """ Returns (artist, title, album) of Deezer API track
+    """
+    return (
+        track_info['artist']['name'], track_info['title'],
+        track_info['album']['title'],
+    )
+
+
+def diffs(track: md.UserTrack, candidates) -> list:
+    """ Returns diffs of `candidates` ((artist, title, album) tuples)
+    with `track`.
+    """
+    candidates = list(candidates)
+    result = [0] * len(candidates)
+    queries = [track.s_artist, track.s_title]
+    if track.s_album:
+        queries.append(track.s_album)
+
+    for idx, query in enumerate(queries):
+        choices = [candidate[idx] or '' for candidate in candidates]
+        for _, distance, pos in process.extract(
+            query or '', choices, scorer=Levenshtein.distance, limit=None,
+        ):
+            result[pos] += distance
+    return result
+
+
+def top(track: md.UserTrack, track_infos, k) -> list:
+    """ Returns up to `k` Deezer API tracks closest to `track` as list of
+    `(track_info, diff)` ordered by diff. Deezer order is kept for the
+    same diff.
+    """
+    track_infos = list(track_infos)
+    scored = zip(track_infos, diffs(track, map(info_attrs, track_infos)))
+    return sorted(scored, key=lambda item: item[1])[:k]
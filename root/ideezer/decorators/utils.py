@@ -22,6 +22,8 @@ def timeit(arg):
     >>> @timeit
     >>> def func():
     >>>     ...
+
+    Generator function is timed until it is exhausted.
     """
     if inspect.isfunction(arg):
         return _timeit(custom_logger=logger)(func=arg)
@@ -31,6 +33,14 @@ def timeit(arg):
 
 def _timeit(custom_logger=None):
     def _deco(func):  # TODO customize disable option
+        if inspect.isgeneratorfunction(func):
+            @wraps(func)
+            def _inner_gen(*args, **kwargs):
+                start = datetime.now()
+                yield from func(*args, **kwargs)
+                custom_logger.info('%s: %s', func.__name__, datetime.now() - start)
+            return _inner_gen
+
         @wraps(func)
         def _inner(*args, **kwargs):
             start = datetime.now()
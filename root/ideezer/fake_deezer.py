@@ -0,0 +1,277 @@
+""" Fake Deezer API for benchmarks and load tests.
+
+Run it:
+
+    python -m ideezer.fake_deezer --port 8001 --latency 0.05 \
+        --error-rate 0.01 --quota 50/5
+
+and point the service to it by settings:
+
+    DEEZER_API_URL=http://localhost:8001
+    DEEZER_CONNECT_URL=http://localhost:8001
+
+Search finds tracks built from the query (so most of tracks are matched),
+`--miss-rate` of tracks is not found. Album tracklists have generic titles.
+Playlists are kept in memory. Requests count is returned by `/_stats`.
+"""
+import argparse
+import asyncio
+import hashlib
+import random
+import re
+import time
+from collections import Counter, defaultdict, deque
+from itertools import count
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+
+ADVANCED_FIELD = re.compile(r'(\w+):"([^"]*)"')
+# titles of the other (worse) search results of track
+VERSIONS = ('', ' (Live)', ' (Remastered)')
+ALBUM_SIZE = 10
+
+
+class Simulation:
+    """ Latency, errors and quota of fake API
+    """
+    def __init__(
+        self, latency=0, jitter=0, error_rate=0, miss_rate=0,
+        quota_calls=0, quota_period=5,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.miss_rate = miss_rate
+        self.quota_calls = quota_calls
+        self.quota_period = quota_period
+        self.stats = Counter()
+        self._calls = defaultdict(deque)
+
+    def quota_exceeded(self, client) -> bool:
+        if not self.quota_calls:
+            return False
+        now = time.monotonic()
+        calls = self._calls[client]
+        while calls and calls[0] <= now - self.quota_period:
+            calls.popleft()
+        if len(calls) >= self.quota_calls:
+            return True
+        calls.append(now)
+        return False
+
+    def missed(self, *parts) -> bool:
+        return _hash(*parts) % 1000 < self.miss_rate * 1000
+
+
+def _hash(*parts) -> int:
+    normalized = '\n'.join(' '.join(part.lower().split()) for part in parts)
+    return int(hashlib.sha1(normalized.encode()).hexdigest()[:12], 16)
+
+
+def _error(type_, message, code):
+    return web.json_response(
+        {'error': {'type': type_, 'message': message, 'code': code}})
+
+
+@web.middleware
+async def simulate(request, handler):
+    sim: Simulation = request.app['simulation']
+    sim.stats[request.path.split('/')[1]] += 1
+    if request.path.startswith(('/oauth/', '/_stats')):
+        return await handler(request)
+
+    delay = sim.latency + random.uniform(0, sim.jitter)
+    if delay:
+        await asyncio.sleep(delay)
+    if random.random() < sim.error_rate:
+        sim.stats['_errors'] += 1
+        raise web.HTTPInternalServerError()
+
+    client = request.query.get('access_token') or request.remote
+    if sim.quota_exceeded(client):
+        sim.stats['_quota_exceeded'] += 1
+        return _error('Exception', 'Quota limit exceeded', 4)
+    return await handler(request)
+
+
+def _track(artist, title, album) -> dict:
+    track_id = _hash(artist, title, album)
+    return {
+        'id': track_id, 'title': title,
+        'link': f'https://www.deezer.com/track/{track_id}',
+        'artist': {'id': _hash(artist), 'name': artist},
+        'album': {'id': _hash(artist, album), 'title': album},
+    }
+
+
+def _parse_query(query):
+    """ Returns (artist, title, album) of advanced or simple query
+    """
+    fields = dict(ADVANCED_FIELD.findall(query))
+    if fields:
+        return (
+            fields.get('artist', ''), fields.get('track', ''),
+            fields.get('album', ''),
+        )
+    artist, _, title = query.partition(' - ')
+    return artist, title, ''
+
+
+async def search(request):
+    artist, title, album = _parse_query(request.query.get('q', ''))
+    limit = int(request.query.get('limit', 25))
+    if request.app['simulation'].missed(artist, title):
+        return web.json_response({'data': [], 'total': 0})
+
+    tracks = [_track(artist, title + version, album) for version in VERSIONS]
+    return web.json_response({'data': tracks[:limit], 'total': len(tracks)})
+
+
+async def search_album(request):
+    artist, _, album = _parse_query(request.query.get('q', ''))
+    if request.app['simulation'].missed(artist, album):
+        return web.json_response({'data': [], 'total': 0})
+
+    album_info = {
+        'id': _hash(artist, album), 'title': album, 'nb_tracks': ALBUM_SIZE,
+        'artist': {'id': _hash(artist), 'name': artist},
+    }
+    request.app['albums'][album_info['id']] = album_info
+    return web.json_response({'data': [album_info], 'total': 1})
+
+
+async def album_tracks(request):
+    album_info = request.app['albums'].get(int(request.match_info['album_id']))
+    if not album_info:
+        return _error('DataException', 'no data', 800)
+
+    tracks = [
+        _track(album_info['artist']['name'], f'Track {number}', album_info['title'])
+        for number in range(1, ALBUM_SIZE + 1)
+    ]
+    for track in tracks:
+        del track['album']
+    return web.json_response({'data': tracks, 'total': len(tracks)})
+
+
+def _token_required(handler):
+    async def _handler(request):
+        if not request.query.get('access_token'):
+            return _error(
+                'OAuthException', 'An active access token must be used', 300)
+        return await handler(request)
+    return _handler
+
+
+@_token_required
+async def create_playlist(request):
+    playlist_id = next(request.app['ids'])
+    request.app['playlists'][playlist_id] = {
+        'id': playlist_id, 'title': request.query.get('title', ''),
+        'link': f'https://www.deezer.com/playlist/{playlist_id}',
+        'tracks': [],
+    }
+    return web.json_response({'id': playlist_id})
+
+
+@_token_required
+async def add_tracks(request):
+    playlist = request.app['playlists'].get(
+        int(request.match_info['playlist_id']))
+    if not playlist:
+        return _error('DataException', 'no data', 800)
+
+    songs = request.query.get('songs', '')
+    playlist['tracks'].extend(int(song) for song in songs.split(',') if song)
+    return web.json_response(True)
+
+
+async def playlist_info(request):
+    playlist = request.app['playlists'].get(
+        int(request.match_info['playlist_id']))
+    if not playlist:
+        return _error('DataException', 'no data', 800)
+
+    return web.json_response(dict(
+        playlist, nb_tracks=len(playlist['tracks']),
+        tracks={'data': [{'id': track_id} for track_id in playlist['tracks']]},
+    ))
+
+
+@_token_required
+async def about_user(request):
+    user_id = _hash(request.query['access_token'])
+    return web.json_response({
+        'id': user_id, 'name': f'Fake user {user_id}', 'picture_small': '',
+    })
+
+
+async def oauth_auth(request):
+    redirect_uri = request.query['redirect_uri']
+    code = hashlib.sha1(str(random.random()).encode()).hexdigest()
+    raise web.HTTPFound(f'{redirect_uri}?{urlencode({"code": code})}')
+
+
+async def oauth_access_token(request):
+    params = dict(request.query)
+    params.update(await request.post())
+    if not params.get('code'):
+        return web.Response(text='wrong code')
+    token = hashlib.sha1(params['code'].encode()).hexdigest()
+    return web.Response(text=f'access_token={token}&expires=3600')
+
+
+async def stats(request):
+    return web.json_response(dict(request.app['simulation'].stats))
+
+
+def make_app(simulation: Simulation = None) -> web.Application:
+    app = web.Application(middlewares=[simulate])
+    app['simulation'] = simulation or Simulation()
+    app['ids'] = count(1)
+    app['albums'] = {}
+    app['playlists'] = {}
+    app.router.add_get('/search', search)
+    app.router.add_get('/search/album', search_album)
+    app.router.add_get('/album/{album_id:\\d+}/tracks', album_tracks)
+    app.router.add_post('/user/me/playlists', create_playlist)
+    app.router.add_post('/playlist/{playlist_id:\\d+}/tracks', add_tracks)
+    app.router.add_get('/playlist/{playlist_id:\\d+}', playlist_info)
+    app.router.add_get('/user/me', about_user)
+    app.router.add_get('/oauth/auth.php', oauth_auth)
+    app.router.add_post('/oauth/access_token.php', oauth_access_token)
+    app.router.add_get('/_stats', stats)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Deezer API')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before every response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='random extra latency up to this value')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of 500 responses')
+    parser.add_argument('--miss-rate', type=float, default=0,
+                        help='share of tracks, which are not found')
+    parser.add_argument('--quota', default='0/5',
+                        help='calls/seconds per client, 0 - unlimited')
+    args = parser.parse_args()
+
+    quota_calls, quota_period = args.quota.split('/')
+    web.run_app(
+        make_app(Simulation(
+            latency=args.latency, jitter=args.jitter,
+            error_rate=args.error_rate, miss_rate=args.miss_rate,
+            quota_calls=int(quota_calls), quota_period=float(quota_period),
+        )),
+        host=args.host, port=args.port,
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -2,4 +2,7 @@ from django import forms
 
 
 class UploadLibraryForm(forms.Form):
-    file = forms.FileField()
+    file = forms.FileField(
+        help_text='"iTunes Library.xml", may be compressed by gzip or zip',
+        widget=forms.ClearableFileInput(attrs={'accept': '.xml,.gz,.zip'}),
+    )
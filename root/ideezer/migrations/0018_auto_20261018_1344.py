@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0017_auto_20190727_1717'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadhistory',
+            name='playlists_updated',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadhistory',
+            name='tracks_updated',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='usertrack',
+            name='itunes_persistent_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
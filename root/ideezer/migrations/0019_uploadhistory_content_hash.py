@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0018_auto_20261018_1344'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadhistory',
+            name='content_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0019_uploadhistory_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task_id', models.CharField(max_length=255, null=True)),
+                ('phase', models.CharField(choices=[('clear', 'Clear'), ('tracks', 'Tracks'), ('playlists', 'Playlists'), ('done', 'Done')], default='clear', max_length=16)),
+                ('position', models.IntegerField(default=0)),
+                ('tracks_deleted', models.IntegerField(default=0)),
+                ('playlists_deleted', models.IntegerField(default=0)),
+                ('tracks_created', models.IntegerField(default=0)),
+                ('playlists_created', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_celery_results', '0011_taskresult_periodic_task_name'),
+        ('ideezer', '0020_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total', models.IntegerField(default=0)),
+                ('done', models.IntegerField(default=0)),
+                ('matched', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('playlist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ideezer.Playlist')),
+                ('task', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='django_celery_results.TaskResult')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-task__date_done'],
+            },
+        ),
+    ]
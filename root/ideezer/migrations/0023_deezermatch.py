@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0022_auto_20261018_1352'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchhistory',
+            name='indexed',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='DeezerMatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('diff', models.IntegerField()),
+                ('hits', models.IntegerField(default=0)),
+                ('deezer_track', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='ideezer.DeezerTrack')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
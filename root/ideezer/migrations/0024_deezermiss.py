@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 13:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0023_deezermatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeezerMiss',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('expires', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+import hashlib
+
+from django.db import migrations
+
+
+BATCH_SIZE = 1000
+# `settings.MATCH_INDEX_MAX_DIFF` at the time of migration: the value and
+# `search_key` are copied, so later changes of them do not change migration
+MAX_DIFF = 10
+
+
+def search_key(artist, title, album) -> str:
+    """ Returns sha1 of normalized (artist, title, album), copy of
+    `ideezer.models.search_key`
+    """
+    normalized = '\n'.join(
+        ' '.join((value or '').lower().split())
+        for value in (artist, title, album)
+    )
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def fill_index(apps, schema_editor):
+    """ Adds chosen pairs made before `DeezerMatch` to index
+    """
+    TrackIdentity = apps.get_model('ideezer', 'TrackIdentity')
+    DeezerMatch = apps.get_model('ideezer', 'DeezerMatch')
+
+    best = {}
+    identities = TrackIdentity.objects.filter(
+        chosen=True, diff__lte=MAX_DIFF,
+    ).select_related('user_track')
+    for identity in identities.iterator():
+        track = identity.user_track
+        key = search_key(
+            track._s_artist or track.artist, track._s_title or track.title,
+            track._s_album or track.album,
+        )
+        if key not in best or identity.diff < best[key].diff:
+            best[key] = DeezerMatch(
+                key=key, deezer_track_id=identity.deezer_track_id,
+                diff=identity.diff,
+            )
+
+    DeezerMatch.objects.bulk_create(
+        best.values(), batch_size=BATCH_SIZE, ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0024_deezermiss'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_index, migrations.RunPython.noop),
+    ]
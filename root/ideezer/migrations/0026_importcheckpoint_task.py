@@ -0,0 +1,25 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ideezer', '0025_deezermatch_backfill'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importcheckpoint',
+            name='task_id',
+            field=models.CharField(max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='importcheckpoint',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -1,16 +1,37 @@
-from django.db import models
+import hashlib
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
 from django.contrib.auth.models import AbstractUser
 from django.urls import reverse
+from django.utils import timezone
 from django_celery_results.models import TaskResult as CeleryTaskResult
-from celery.states import FAILURE
+from celery.states import FAILURE, SUCCESS, UNREADY_STATES
 import Levenshtein
 
+from .controllers.db_loader import chunked
+
 
 ITUNES = 'itunes'
 DEEZER = 'deezer'
 source_names = {ITUNES: 'iTunes', DEEZER: 'Deezer'}
 
 
+def search_key(artist, title, album) -> str:
+    """ Returns sha1 of normalized (artist, title, album)
+    """
+    normalized = '\n'.join(
+        ' '.join((value or '').lower().split())
+        for value in (artist, title, album)
+    )
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
 class BaseModel(models.Model):
     class Meta:
         abstract = True
@@ -78,7 +99,11 @@ class UploadHistory(BaseModel):
     playlists_deleted = models.IntegerField(null=True)
     tracks_created = models.IntegerField(null=True)
     playlists_created = models.IntegerField(null=True)
+    tracks_updated = models.IntegerField(null=True)
+    playlists_updated = models.IntegerField(null=True)
     message = models.CharField(max_length=255, null=True)
+    # sha256 of uploaded file
+    content_hash = models.CharField(max_length=64, null=True)
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     task = models.OneToOneField(
@@ -88,25 +113,59 @@ class UploadHistory(BaseModel):
     objects = _Manager()
 
     DEFAULT_ERROR_MESSAGE = 'Server error'
+    UNCHANGED_MESSAGE = 'Unchanged'
 
     class Meta:
         ordering = ['-task__date_done']
 
     @classmethod
-    def create(cls, task_id, user_id):
+    def create(cls, task_id, user_id, content_hash=None):
         task = CeleryTaskResult.objects.get_task(task_id=task_id)
-        obj = cls(task=task, user_id=user_id)
+        # redelivered task has the entry already
+        obj = cls._search(task=task) if task.pk else None
+        if obj:
+            return obj
+
+        obj = cls(task=task, user_id=user_id, content_hash=content_hash)
+        obj.save()
+        return obj
+
+    @classmethod
+    def create_unchanged(cls, user_id, content_hash):
+        """ Creates successful entry for upload, which processing was skipped
+        """
+        task = CeleryTaskResult.objects.get_task(task_id=str(uuid.uuid4()))
+        task.status = SUCCESS
+        task.save()
+        obj = cls(
+            task=task, user_id=user_id, content_hash=content_hash,
+            message=cls.UNCHANGED_MESSAGE,
+        )
         obj.save()
         return obj
 
+    @classmethod
+    def last_imported_hash(cls, user_id):
+        """ Returns hash of the file, which user library is imported from.
+        It is known only when the latest upload of user is successful
+        (failed one may leave library partly imported).
+        """
+        last = cls.objects.by_user(user_id).select_related('task').first()
+        if last and last.task.status == SUCCESS:
+            return last.content_hash
+        return None
+
     def update_info(
         self, playlists_deleted, tracks_deleted,
         playlists_created, tracks_created,
+        playlists_updated=None, tracks_updated=None,
     ):
         self.playlists_deleted = playlists_deleted
         self.tracks_deleted = tracks_deleted
         self.playlists_created = playlists_created
         self.tracks_created = tracks_created
+        self.playlists_updated = playlists_updated
+        self.tracks_updated = tracks_updated
         self.save()
 
     @property
@@ -115,8 +174,168 @@ class UploadHistory(BaseModel):
             return self.message or self.DEFAULT_ERROR_MESSAGE
 
 
+class SearchInProgress(Exception):
+    pass
+
+
+class SearchHistory(BaseModel):
+    """ Progress of Deezer search for playlist tracks.
+    """
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    matched = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    # matched by `DeezerMatch` index without Deezer requests
+    indexed = models.IntegerField(default=0)
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # search for the whole user library, when playlist is None
+    playlist = models.ForeignKey(
+        'Playlist', on_delete=models.CASCADE, null=True, blank=True,
+    )
+    task = models.OneToOneField(
+        CeleryTaskResult, on_delete=models.CASCADE, unique=True,
+    )
+
+    objects = _Manager()
+
+    DEFAULT_ERROR_MESSAGE = 'Server error'
+
+    class Meta:
+        ordering = ['-task__date_done']
+
+    @classmethod
+    def create(cls, task_id, user_id, playlist_id=None):
+        task = CeleryTaskResult.objects.get_task(task_id=task_id)
+        obj = cls._search(task=task) if task.pk else None
+        if obj:
+            return obj
+
+        obj = cls(task=task, user_id=user_id, playlist_id=playlist_id)
+        obj.save()
+        return obj
+
+    @classmethod
+    def create_pending(cls, user_id, playlist_id):
+        """ Creates entry of playlist search with pending task, before the
+        task is sent.
+
+        Raises `SearchInProgress`, when other search of the playlist is not
+        done and its task was updated for the last `SEARCH_TIMEOUT` seconds.
+        """
+        with transaction.atomic():
+            # searches of the same playlist are started one by one
+            Playlist.objects.select_for_update().get(pk=playlist_id)
+            alive = timezone.now() - timedelta(seconds=settings.SEARCH_TIMEOUT)
+            if cls.objects.filter(
+                playlist_id=playlist_id, task__status__in=UNREADY_STATES,
+                task__date_done__gt=alive,
+            ).exists():
+                raise SearchInProgress(
+                    f'other search of playlist {playlist_id} is in progress'
+                )
+            task = CeleryTaskResult.objects.get_task(task_id=str(uuid.uuid4()))
+            task.save()
+            return cls.create(
+                task_id=task.task_id, user_id=user_id, playlist_id=playlist_id,
+            )
+
+    def update_progress(self, **kwargs):
+        for attr, value in kwargs.items():
+            setattr(self, attr, value)
+        self.save(update_fields=list(kwargs))
+
+    @property
+    def in_progress(self):
+        return self.task.status in UNREADY_STATES
+
+    @property
+    def error(self):
+        if self.task.status == FAILURE:
+            return self.DEFAULT_ERROR_MESSAGE
+
+    def as_dict(self):
+        return dict(
+            status=self.task.status, in_progress=self.in_progress,
+            total=self.total, done=self.done,
+            matched=self.matched, failed=self.failed, indexed=self.indexed,
+        )
+
+
+class ImportInProgress(Exception):
+    pass
+
+
+class ImportCheckpoint(BaseModel):
+    """ Progress of resumable iTunes library import (task).
+    """
+    CLEAR = 'clear'
+    TRACKS = 'tracks'
+    PLAYLISTS = 'playlists'
+    DONE = 'done'
+    PHASES = (
+        (CLEAR, 'Clear'),
+        (TRACKS, 'Tracks'),
+        (PLAYLISTS, 'Playlists'),
+        (DONE, 'Done'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    task_id = models.CharField(max_length=255, null=True, unique=True)
+    phase = models.CharField(max_length=16, choices=PHASES, default=CLEAR)
+    # count of items of the phase, which are already committed
+    position = models.IntegerField(default=0)
+
+    tracks_deleted = models.IntegerField(default=0)
+    playlists_deleted = models.IntegerField(default=0)
+    tracks_created = models.IntegerField(default=0)
+    playlists_created = models.IntegerField(default=0)
+
+    updated = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def start(cls, user_id, task_id):
+        """ Returns checkpoint of the task `task_id`, when it is retried,
+        and new checkpoint otherwise.
+
+        Raises `ImportInProgress`, when other import of the user is not
+        done and its checkpoint was updated for the last
+        `IMPORT_CHECKPOINT_TIMEOUT` seconds.
+        """
+        with transaction.atomic():
+            # imports of the same user are started one by one
+            User.objects.select_for_update().get(pk=user_id)
+            obj = cls._search(task_id=task_id) if task_id else None
+            if obj:
+                return obj
+
+            others = cls.objects.filter(user_id=user_id)
+            alive = timezone.now() - timedelta(
+                seconds=settings.IMPORT_CHECKPOINT_TIMEOUT,
+            )
+            if others.exclude(phase=cls.DONE).filter(updated__gt=alive).exists():
+                raise ImportInProgress(
+                    f'other library import of user {user_id} is in progress'
+                )
+            others.delete()
+            return cls._create(user_id=user_id, task_id=task_id)
+
+    @classmethod
+    def release(cls, task_id):
+        """ Removes checkpoint of failed task `task_id`, the task is not
+        resumed and other import of the user is not refused.
+        """
+        cls.objects.filter(task_id=task_id).delete()
+
+    def commit(self, **kwargs):
+        for attr, value in kwargs.items():
+            setattr(self, attr, value)
+        self.save()
+
+
 class UserTrack(BaseTrack):
     itunes_id = models.BigIntegerField()  # id from iTunes xml
+    itunes_persistent_id = models.CharField(max_length=255, null=True, blank=True)
     # `s_`-attribute for track search by Deezer API.
     _s_title = models.CharField(db_column='s_title', max_length=255, null=True, blank=True)
     _s_artist = models.CharField(db_column='s_artist', max_length=255, null=True, blank=True)
@@ -145,6 +364,10 @@ class UserTrack(BaseTrack):
     def s_album(self):
         return self._s_album or self.album
 
+    @property
+    def search_key(self):
+        return search_key(self.s_artist, self.s_title, self.s_album)
+
     def get_absolute_url(self):
         return reverse('track_edit', args=[self.pk])
 
@@ -152,6 +375,7 @@ class UserTrack(BaseTrack):
     def from_itunes(cls, track, user_id):
         return cls(
             itunes_id=track.track_id,
+            itunes_persistent_id=track.persistent_id,
             title=track.name,
             artist=track.artist,
             album=track.album,
@@ -169,14 +393,37 @@ class DeezerTrack(BaseTrack):
         if obj:
             return obj
 
-        obj = cls(
-            deezer_id=deezer_id,
+        obj = cls._from_info(track_info)
+        obj.save()
+        return obj
+
+    @classmethod
+    def from_deezer_many(cls, track_infos) -> list:
+        """ Bulk version of `from_deezer`: inserts missed tracks by the
+        single `INSERT ... ON CONFLICT DO NOTHING` and selects all of them
+        by the single query.
+
+        Returns tracks in order of `track_infos`.
+        """
+        track_infos = list(track_infos)
+        objs = {}
+        for track_info in track_infos:
+            objs.setdefault(track_info['id'], cls._from_info(track_info))
+        if not objs:
+            return []
+
+        cls.objects.bulk_create(objs.values(), ignore_conflicts=True)
+        saved = cls.objects.in_bulk(list(objs), field_name='deezer_id')
+        return [saved[track_info['id']] for track_info in track_infos]
+
+    @classmethod
+    def _from_info(cls, track_info):
+        return cls(
+            deezer_id=track_info['id'],
             title=track_info['title'],
             artist=track_info['artist']['name'],
             album=track_info['album']['title'],
         )
-        obj.save()
-        return obj
 
 
 class TrackIdentity(BaseModel):
@@ -241,12 +488,169 @@ class TrackIdentity(BaseModel):
 
         pair = cls.objects.filter(
             user_track=user_track,
-        ).order_by('-diff').first()
+        ).order_by('diff').first()
         if pair:
             pair.chosen = True
             pair.save()
             return True
 
+    @classmethod
+    def mark_exists_tracks_as_pairs(cls, user_tracks) -> int:
+        """ Bulk version of `mark_exists_track_as_pair`: for every track
+        from `user_tracks` queryset without `chosen` deezer pair marks
+        the best available candidate as `chosen`.
+
+        Returns count of marked tracks.
+        """
+        candidates = cls.objects.filter(
+            user_track__in=user_tracks.exclude(trackidentity__chosen=True),
+        ).order_by('user_track_id', 'diff').values_list('id', 'user_track_id')
+
+        best = {}
+        for pk, user_track_id in candidates:
+            best.setdefault(user_track_id, pk)
+
+        for chunk in chunked(best.values(), settings.PAIRS_BATCH_SIZE):
+            cls.objects.filter(pk__in=chunk).update(chosen=True)
+            DeezerMatch.record(cls.objects.filter(
+                pk__in=chunk,
+            ).select_related('user_track', 'deezer_track'))
+        return len(best)
+
+
+class DeezerMatch(BaseModel):
+    """ Index of accepted pairs shared by all users: search key of
+    iTunes track -> the best Deezer track for it.
+    """
+    # `search_key` of iTunes track
+    key = models.CharField(max_length=40, unique=True)
+    deezer_track = models.ForeignKey(DeezerTrack, on_delete=models.CASCADE)
+    diff = models.IntegerField()
+    # how many times the pair was taken from index
+    hits = models.IntegerField(default=0)
+
+    @classmethod
+    def lookup(cls, user_tracks) -> dict:
+        """ Returns dict `{user_track: deezer_track}` for tracks found in
+        index (by the single query) and counts hits of found pairs.
+        """
+        keys = {track: track.search_key for track in user_tracks}
+        matches = cls.objects.select_related('deezer_track').in_bulk(
+            list(set(keys.values())), field_name='key',
+        )
+        if matches:
+            cls.objects.filter(
+                pk__in=[match.pk for match in matches.values()],
+            ).update(hits=F('hits') + 1)
+
+        return {
+            track: matches[key].deezer_track
+            for track, key in keys.items() if key in matches
+        }
+
+    @classmethod
+    def indexed(cls, user_tracks) -> set:
+        """ Returns tracks from `user_tracks` found in index, hits are not
+        counted
+        """
+        keys = {track: track.search_key for track in user_tracks}
+        indexed = set(cls.objects.filter(
+            key__in=set(keys.values()),
+        ).values_list('key', flat=True))
+        return {track for track, key in keys.items() if key in indexed}
+
+    @classmethod
+    def record(cls, identities) -> int:
+        """ Adds chosen `identities` with diff up to
+        `settings.MATCH_INDEX_MAX_DIFF` to index. Pair with lower diff
+        replaces the indexed one.
+
+        Returns count of added or replaced pairs.
+        """
+        best = {}
+        for identity in identities:
+            if not identity.chosen \
+                    or identity.diff > settings.MATCH_INDEX_MAX_DIFF:
+                continue
+            key = identity.user_track.search_key
+            if key not in best or identity.diff < best[key].diff:
+                best[key] = cls(
+                    key=key, deezer_track_id=identity.deezer_track_id,
+                    diff=identity.diff,
+                )
+        if not best:
+            return 0
+
+        exists = cls.objects.in_bulk(list(best), field_name='key')
+        cls.objects.bulk_create(
+            [match for key, match in best.items() if key not in exists],
+            ignore_conflicts=True,
+        )
+
+        recorded = len(best) - len(exists)
+        for key, match in exists.items():
+            if best[key].diff < match.diff:
+                cls.objects.filter(pk=match.pk).update(
+                    deezer_track_id=best[key].deezer_track_id,
+                    diff=best[key].diff, hits=0,
+                )
+                recorded += 1
+        return recorded
+
+    @classmethod
+    def forget(cls, identity):
+        """ Counts rejection of `identity` pair by user: rejection takes
+        back one hit of indexed pair, pair without hits is removed from
+        index. So pair used by many users is not removed by one of them.
+        """
+        matches = cls.objects.filter(
+            key=identity.user_track.search_key,
+            deezer_track_id=identity.deezer_track_id,
+        )
+        matches.filter(hits__lte=0).delete()
+        matches.update(hits=F('hits') - 1)
+
+
+class DeezerMiss(BaseModel):
+    """ iTunes tracks, which are not found by any Deezer search.
+    They are not searched again until `expires`.
+    """
+    # `search_key` of iTunes track
+    key = models.CharField(max_length=40, unique=True)
+    expires = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def missed(cls, user_tracks) -> set:
+        """ Returns tracks from `user_tracks` known as missed
+        """
+        keys = {track: track.search_key for track in user_tracks}
+        missed = set(cls.objects.filter(
+            key__in=set(keys.values()), expires__gt=timezone.now(),
+        ).values_list('key', flat=True))
+        return {track for track, key in keys.items() if key in missed}
+
+    @classmethod
+    def remember(cls, user_tracks):
+        """ Marks `user_tracks` as missed for `settings.DEEZER_MISS_TTL`
+        seconds.
+        """
+        now = timezone.now()
+        cls.objects.filter(expires__lte=now).delete()
+        expires = now + timedelta(seconds=settings.DEEZER_MISS_TTL)
+        cls.objects.bulk_create(
+            [
+                cls(key=key, expires=expires)
+                for key in {track.search_key for track in user_tracks}
+            ],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def forget(cls, user_tracks):
+        cls.objects.filter(
+            key__in={track.search_key for track in user_tracks},
+        ).delete()
+
 
 class Playlist(BaseModel):
     itunes_id = models.BigIntegerField()
@@ -262,6 +666,9 @@ class Playlist(BaseModel):
 
     objects = _Manager()
 
+    # set when tracks are added to `itunes_content`
+    _content_changed = False
+
     class Meta:
         unique_together = (
             ('user', 'itunes_id')
@@ -295,6 +702,19 @@ class Playlist(BaseModel):
             itunes_title=playlist.name,
         )
 
+    @classmethod
+    def check_content_owner(cls, playlist_ids):
+        """ Checks playlists contain only tracks from playlist.user
+        (by the single query).
+        """
+        mismatched = cls.itunes_content.through.objects.filter(
+            playlist_id__in=list(playlist_ids),
+        ).exclude(
+            usertrack__user=F('playlist__user'),
+        )
+        if mismatched.exists():
+            raise ValueError('Playlist tracks must belongs to playlist User')
+
     def __str__(self):
         itunes = f'{self.itunes_title} ({self.itunes_content.count()})'
 
@@ -317,9 +737,30 @@ class Playlist(BaseModel):
             raise ValueError(err)
 
         # check playlist contains only tracks from playlist.user
-        if self.pk:
-            for itunes_track in self.itunes_content.all():
-                if itunes_track.user != self.user:
-                    err = 'Playlist tracks must belongs to playlist User'
-                    raise ValueError(err)
+        if self.pk and self._content_changed:
+            self.check_content_owner([self.pk])
+            self._content_changed = False
         return super(Playlist, self).save(*args, **kwargs)
+
+
+@receiver(m2m_changed, sender=Playlist.itunes_content.through)
+def playlist_content_changed(instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # tracks are added from `UserTrack` side: there is no playlist
+        # instance to check on saving, so playlists are checked before
+        # adding (by the single query)
+        if action == 'pre_add' and Playlist.objects.filter(
+            pk__in=pk_set,
+        ).exclude(user_id=instance.user_id).exists():
+            raise ValueError('Playlist tracks must belongs to playlist User')
+    elif action == 'post_add':
+        instance._content_changed = True
+
+
+@receiver(post_save, sender=TrackIdentity)
+def track_identity_saved(instance, **kwargs):
+    if instance.chosen:
+        DeezerMatch.record([instance])
+    elif instance.chosen is False:
+        # user has chosen other pair for the track
+        DeezerMatch.forget(instance)
@@ -1,9 +1,31 @@
+from io import BytesIO
+import asyncio
 from random import randint
+from unittest import mock
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from plistlib import InvalidFileException
+import gzip
+import os
+import threading
+import time
 import uuid
+import zipfile
 
-from django.test import TestCase
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django_celery_results.models import TaskResult as CeleryTaskResult
 
-from . import models as md
+from . import fake_deezer, models as md
+from .controllers import (
+    db_loader, deezer_album, deezer_async, deezer_base, deezer_breaker,
+    deezer_cache, deezer_quota, deezer_search, itunes_xml, library,
+    matching, pipeline, scoring,
+)
 
 
 def strand(length=None):
@@ -20,6 +42,77 @@ def create_user_track(user):
     )
 
 
+ITUNES_XML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+    <key>Major Version</key><integer>1</integer>
+    <key>Date</key><date>2019-01-06T10:29:00Z</date>
+    <key>Tracks</key>
+    <dict>
+        <key>101</key>
+        <dict>
+            <key>Track ID</key><integer>101</integer>
+            <key>Name</key><string>Song 1</string>
+            <key>Artist</key><string>Artist 1</string>
+            <key>Album</key><string>Album 1</string>
+            <key>Persistent ID</key><string>AAAA0000AAAA0001</string>
+        </dict>
+        <key>102</key>
+        <dict>
+            <key>Track ID</key><integer>102</integer>
+            <key>Name</key><string>Song 2</string>
+            <key>Artist</key><string>Artist 2</string>
+            <key>Persistent ID</key><string>AAAA0000AAAA0002</string>
+        </dict>
+    </dict>
+    <key>Playlists</key>
+    <array>
+        <dict>
+            <key>Name</key><string>Library</string>
+            <key>Master</key><true/>
+            <key>Playlist ID</key><integer>1</integer>
+            <key>Playlist Persistent ID</key><string>BBBB0000BBBB0001</string>
+            <key>Playlist Items</key>
+            <array>
+                <dict><key>Track ID</key><integer>101</integer></dict>
+                <dict><key>Track ID</key><integer>102</integer></dict>
+            </array>
+        </dict>
+        <dict>
+            <key>Name</key><string>Favourites</string>
+            <key>Playlist ID</key><integer>2</integer>
+            <key>Playlist Persistent ID</key><string>BBBB0000BBBB0002</string>
+            <key>Playlist Items</key>
+            <array>
+                <dict><key>Track ID</key><integer>102</integer></dict>
+            </array>
+        </dict>
+        <dict>
+            <key>Name</key><string>Folder</string>
+            <key>Playlist ID</key><integer>3</integer>
+            <key>Playlist Persistent ID</key><string>BBBB0000BBBB0003</string>
+            <key>Folder</key><true/>
+        </dict>
+    </array>
+</dict>
+</plist>
+'''
+
+
+def create_itunes_xml(content=ITUNES_XML):
+    with NamedTemporaryFile(suffix='.xml', delete=False) as tmp:
+        tmp.write(content)
+    return tmp.name
+
+
+def deezer_track_info(deezer_id=None):
+    return {
+        'id': deezer_id or intrand(), 'title': strand(),
+        'artist': {'name': strand()}, 'album': {'title': strand()},
+    }
+
+
 def create_playlist(user):
     return md.Playlist.objects.create(
         itunes_title=strand(), itunes_id=intrand(), user=user
@@ -81,3 +174,1241 @@ class PlaylistTestCase(TestCase):
             ValueError, 'Playlist tracks must belongs to playlist User'
         ):
             plst.save()
+
+    def test_content_unchanged(self):
+        plst = create_playlist(user=self.user1)
+        plst.itunes_content.add(*[track for track in self.consistent_tracks])
+        plst.save()
+        with self.assertNumQueries(1):
+            plst.save()
+
+    def test_content_err_reverse(self):
+        plst = create_playlist(user=self.user1)
+        with self.assertRaisesMessage(
+            ValueError, 'Playlist tracks must belongs to playlist User'
+        ), transaction.atomic():
+            self.unconsistent_tracks[1].playlist_set.add(plst)
+        self.assertFalse(plst.itunes_content.exists())
+
+    def test_check_content_owner(self):
+        plst = create_playlist(user=self.user1)
+        plst.itunes_content.add(*[track for track in self.consistent_tracks])
+        md.Playlist.check_content_owner([plst.pk])
+
+        plst.itunes_content.add(*[track for track in self.unconsistent_tracks])
+        with self.assertRaisesMessage(
+            ValueError, 'Playlist tracks must belongs to playlist User'
+        ):
+            md.Playlist.check_content_owner([plst.pk])
+
+
+class ItunesXmlTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+        self.lib = itunes_xml.StreamLibrary(self.create_itunes_xml())
+
+    def create_itunes_xml(self, content=ITUNES_XML):
+        path = create_itunes_xml(content)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_tracks(self):
+        tracks = list(self.lib.tracks())
+        self.assertEqual([track.track_id for track in tracks], [101, 102])
+        self.assertEqual(tracks[0].album, 'Album 1')
+        self.assertIsNone(tracks[1].album)
+
+    def test_playlists(self):
+        playlists = list(self.lib.playlists())
+        self.assertEqual([p.name for p in playlists], ['Favourites', 'Folder'])
+        self.assertEqual(playlists[0].track_ids, (102, ))
+        self.assertTrue(playlists[1].is_folder)
+
+    def test_compressed(self):
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            zip_file.writestr('iTunes Library.xml', ITUNES_XML)
+
+        for content in (gzip.compress(ITUNES_XML), archive.getvalue()):
+            lib = itunes_xml.StreamLibrary(self.create_itunes_xml(content))
+            self.assertEqual(
+                [track.track_id for track in lib.tracks()], [101, 102])
+
+    def test_invalid_file(self):
+        lib = itunes_xml.StreamLibrary(
+            self.create_itunes_xml(b'<plist><dict>'))
+        with self.assertRaises(InvalidFileException):
+            list(lib.tracks())
+
+    def test_process(self):
+        create_user_track(self.user)
+        result = library.process(
+            path=self.lib.path, user_id=self.user.id, mode=library.FULL)
+        self.assertEqual(result, dict(
+            playlists_deleted=0, tracks_deleted=1,
+            playlists_created=1, tracks_created=2,
+            playlists_updated=0, tracks_updated=0,
+        ))
+        playlist = md.Playlist.objects.by_user(self.user.id).get()
+        self.assertEqual(
+            [track.itunes_id for track in playlist.itunes_content.all()],
+            [102],
+        )
+
+    def test_process_incremental(self):
+        library.process(path=self.lib.path, user_id=self.user.id)
+        track = md.UserTrack.objects.get(user=self.user, itunes_id=101)
+        deezer_track = md.DeezerTrack.objects.create(
+            deezer_id=intrand(), title=strand())
+        md.TrackIdentity.objects.create(
+            user_track=track, deezer_track=deezer_track, diff=0, chosen=True)
+
+        # the first track id is changed by iTunes, but persistent id is not;
+        # the second track is replaced by new one
+        content = ITUNES_XML.replace(b'101', b'201').replace(
+            b'102', b'103',
+        ).replace(
+            b'AAAA0000AAAA0002', b'AAAA0000AAAA0003',
+        )
+        result = library.process(
+            path=self.create_itunes_xml(content), user_id=self.user.id)
+        self.assertEqual(result, dict(
+            playlists_deleted=0, tracks_deleted=1,
+            playlists_created=0, tracks_created=1,
+            playlists_updated=1, tracks_updated=1,
+        ))
+
+        track = md.UserTrack.objects.get(pk=track.pk)
+        self.assertEqual(track.itunes_id, 201)
+        self.assertTrue(track.trackidentity_set.filter(chosen=True).exists())
+
+        # renamed track is unpaired
+        result = library.process(
+            path=self.create_itunes_xml(content.replace(b'Song 1', b'Song 4')),
+            user_id=self.user.id,
+        )
+        self.assertEqual(result['tracks_updated'], 1)
+        self.assertFalse(track.trackidentity_set.exists())
+
+    def test_sync_playlists_queries(self):
+        def _library(playlists_cnt, version):
+            tracks = [
+                itunes_xml.ItunesTrack(100 + i, None, f'Song {i}', 'Artist', None)
+                for i in range(3)
+            ]
+            playlists = [
+                itunes_xml.ItunesPlaylist(
+                    i, f'P{i}', f'Playlist {i} {version}', False, None,
+                    (100 + (i + version) % 3, ),
+                )
+                for i in range(1, playlists_cnt + 1)
+            ]
+            return mock.Mock(
+                tracks=lambda: iter(tracks), playlists=lambda: iter(playlists),
+            )
+
+        queries_cnt = []
+        for playlists_cnt in (2, 10):
+            user = md.User.objects.create_user(strand())
+            library.sync_tracks(_library(playlists_cnt, 0), user.id)
+            library.sync_playlists(_library(playlists_cnt, 0), user.id)
+            with CaptureQueriesContext(connection) as queries:
+                result = library.sync_playlists(
+                    _library(playlists_cnt, 1), user.id)
+            self.assertEqual(result, (0, playlists_cnt, 0))
+            queries_cnt.append(len(queries))
+
+            playlist = md.Playlist.objects.by_user(user.id).get(itunes_id=1)
+            self.assertEqual(playlist.itunes_title, 'Playlist 1 1')
+            self.assertEqual(
+                [track.itunes_id for track in playlist.itunes_content.all()],
+                [102],
+            )
+        self.assertEqual(queries_cnt[0], queries_cnt[1])
+
+    @override_settings(IMPORT_BATCH_SIZE=1)
+    def test_process_resumable(self):
+        class _BrokenLibrary(itunes_xml.StreamLibrary):
+            def tracks(self):
+                tracks = super(_BrokenLibrary, self).tracks()
+                yield next(tracks)
+                raise InvalidFileException()
+
+        # the task is interrupted as by lost worker, it is redelivered then
+        broken = _BrokenLibrary(self.lib.path)
+        with self.assertRaises(InvalidFileException):
+            library.process_resumable(broken, self.user.id, task_id='task')
+        checkpoint = md.ImportCheckpoint.objects.get(user=self.user)
+        self.assertEqual(checkpoint.phase, checkpoint.TRACKS)
+        self.assertEqual(checkpoint.position, 1)
+
+        # other import waits for the unfinished one
+        with self.assertRaises(md.ImportInProgress):
+            library.process_resumable(self.lib, self.user.id, task_id='other')
+
+        result = library.process_resumable(
+            self.lib, self.user.id, task_id='task')
+        self.assertEqual(result['tracks_created'], 2)
+        self.assertEqual(result['playlists_created'], 1)
+        self.assertEqual(
+            md.UserTrack.objects.by_user(self.user.id).count(), 2)
+
+        library.process_resumable(self.lib, self.user.id, task_id='other')
+        self.assertEqual(
+            md.ImportCheckpoint.objects.get(user=self.user).task_id, 'other')
+
+    def test_invalid_file_kept_data(self):
+        track = create_user_track(self.user)
+        invalid = itunes_xml.StreamLibrary(
+            self.create_itunes_xml(b'<plist><dict>'))
+        with self.assertRaises(InvalidFileException):
+            library.process_resumable(invalid, self.user.id, task_id='task')
+        self.assertTrue(md.UserTrack.objects.filter(pk=track.pk).exists())
+
+    @override_settings(IMPORT_BATCH_SIZE=1)
+    def test_failed_checkpoint_released(self):
+        class _BrokenLibrary(itunes_xml.StreamLibrary):
+            def tracks(self):
+                tracks = super(_BrokenLibrary, self).tracks()
+                yield next(tracks)
+                raise InvalidFileException()
+
+        task = CeleryTaskResult.objects.create(task_id='task')
+        md.UploadHistory.objects.create(task=task, user=self.user)
+        broken = _BrokenLibrary(self.lib.path)
+        with self.assertRaises(InvalidFileException) as error:
+            library.process_resumable(broken, self.user.id, task_id='task')
+        library.library_upload_failure_handler('task', error.exception)
+        self.assertFalse(md.ImportCheckpoint.objects.exists())
+
+        result = library.process_resumable(
+            self.lib, self.user.id, task_id='other')
+        self.assertEqual(result['tracks_created'], 2)
+
+    def test_stale_checkpoint_replaced(self):
+        md.ImportCheckpoint.start(user_id=self.user.id, task_id='dead')
+        with override_settings(IMPORT_CHECKPOINT_TIMEOUT=0):
+            library.process_resumable(self.lib, self.user.id, task_id='task')
+        self.assertEqual(
+            md.ImportCheckpoint.objects.get(user=self.user).task_id, 'task')
+
+
+class LibraryUploadTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+        upload_dir = TemporaryDirectory()
+        self.addCleanup(upload_dir.cleanup)
+        upload_path = override_settings(UPLOAD_PATH=upload_dir.name)
+        upload_path.enable()
+        self.addCleanup(upload_path.disable)
+
+    def test_store_upload(self):
+        path1, hash1 = library.store_upload(SimpleUploadedFile('1', ITUNES_XML))
+        path2, hash2 = library.store_upload(SimpleUploadedFile('2', ITUNES_XML))
+        self.assertEqual((path1, hash1), (path2, hash2))
+        self.assertEqual(len(os.listdir(os.path.dirname(path1))), 1)
+
+        path, _ = library.store_upload(
+            SimpleUploadedFile('3', gzip.compress(ITUNES_XML)))
+        self.assertTrue(path.endswith('.xml.gz'))
+
+    def test_unchanged(self):
+        _, content_hash = library.store_upload(
+            SimpleUploadedFile('1', ITUNES_XML))
+        task = CeleryTaskResult.objects.create(
+            task_id=strand(), status='SUCCESS')
+        md.UploadHistory.objects.create(
+            task=task, user=self.user, content_hash=content_hash)
+
+        self.assertFalse(library.save(
+            SimpleUploadedFile('2', ITUNES_XML), self.user))
+        history = md.UploadHistory.objects.by_user(self.user.id).first()
+        self.assertEqual(history.message, md.UploadHistory.UNCHANGED_MESSAGE)
+        self.assertEqual(history.content_hash, content_hash)
+
+    def test_changed_after_failure(self):
+        _, content_hash = library.store_upload(
+            SimpleUploadedFile('1', ITUNES_XML))
+        for status, hash_ in (('SUCCESS', content_hash), ('FAILURE', strand())):
+            task = CeleryTaskResult.objects.create(
+                task_id=strand(), status=status)
+            md.UploadHistory.objects.create(
+                task=task, user=self.user, content_hash=hash_)
+
+        self.assertIsNone(md.UploadHistory.last_imported_hash(self.user.id))
+        with mock.patch.object(library.celery_app, 'send_task') as send_task:
+            self.assertTrue(library.save(
+                SimpleUploadedFile('2', ITUNES_XML), self.user))
+        send_task.assert_called_once()
+
+
+class DbLoaderTestCase(TestCase):
+    def test_copy_stream(self):
+        stream = db_loader._CopyStream([[1, 'a\tb', None], [2, 'c\\', True]])
+        data = ''
+        chunk = stream.read(3)
+        while chunk:
+            data += chunk
+            chunk = stream.read(3)
+        self.assertEqual(data, '1\ta\\tb\t\\N\n2\tc\\\\\tt\n')
+        self.assertEqual(stream.rows_cnt, 2)
+
+    def test_copy_fallback(self):
+        user = md.User.objects.create_user(strand())
+        tracks = (
+            md.UserTrack(itunes_id=idx, title=strand(), user=user)
+            for idx in range(5)
+        )
+        loader = db_loader.get_loader(db_loader.COPY, batch_size=2)
+        self.assertEqual(loader.insert(md.UserTrack, tracks), 5)
+        self.assertEqual(md.UserTrack.objects.by_user(user.id).count(), 5)
+
+
+class PipelineTestCase(TestCase):
+    def test_prefetch(self):
+        items = pipeline.prefetch(range(10), maxsize=2)
+        self.assertEqual(list(items), list(range(10)))
+
+    def test_prefetch_error(self):
+        def _items():
+            yield 1
+            raise InvalidFileException()
+
+        items = pipeline.prefetch(_items(), maxsize=1)
+        self.assertEqual(next(items), 1)
+        with self.assertRaises(InvalidFileException):
+            next(items)
+
+    def test_prefetch_stop(self):
+        items = pipeline.prefetch(iter(range(100)), maxsize=1)
+        self.assertEqual(next(items), 0)
+        items.close()
+
+
+class RedisLimiterTestCase(TestCase):
+    """ Runs against `DEEZER_LIMITER_REDIS_URL`, skipped without Redis """
+    def setUp(self):
+        import redis
+
+        client = redis.Redis.from_url(settings.DEEZER_LIMITER_REDIS_URL)
+        try:
+            client.ping()
+        except redis.RedisError:
+            self.skipTest('Redis is unavailable')
+
+        prefix = f'ideezer:test:{strand()}:'
+        self.addCleanup(lambda: [
+            client.delete(key) for key in client.scan_iter(f'{prefix}*')
+        ])
+        self.limiter = deezer_quota.RedisLimiter(
+            settings.DEEZER_LIMITER_REDIS_URL, deezer_quota.Quotas(
+                calls=2, period=0.4, user_calls=0, endpoint_calls={},
+            ),
+        )
+        self.limiter.PREFIX = prefix
+
+    def test_acquire(self):
+        start = time.monotonic()
+        self.limiter.acquire('search')
+        self.limiter.acquire('search')
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.limiter.acquire('search')
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def test_live_waiter_keeps_place(self):
+        prefix = self.limiter.PREFIX
+        keys = [f'{prefix}app', f'{prefix}queue', f'{prefix}seen']
+
+        def _take(waiter):
+            # one token, no refill, waiters are dropped after 0.3 sec
+            return float(self.limiter._take(
+                keys=keys, args=[1, 0.0001, 60, waiter, 0.3],
+            ))
+
+        self.assertEqual(_take('first'), 0)
+        self.assertGreater(_take('a'), 0)
+        self.assertGreater(_take('b'), 0)
+        time.sleep(0.2)
+        _take('a')
+        time.sleep(0.2)
+        _take('b')
+        self.assertEqual(
+            self.limiter._redis.zrange(keys[1], 0, -1), [b'a', b'b'],
+        )
+
+
+class DeezerRequestTestCase(TestCase):
+    def _session(self, *responses):
+        calls = []
+
+        def _request(method, url, **kwargs):
+            calls.append((method, kwargs['timeout']))
+            status, json = responses[len(calls) - 1]
+            response = mock.Mock(status_code=status)
+            response.json.return_value = json
+            response.raise_for_status.side_effect = (
+                deezer_base.requests.HTTPError() if status >= 400 else None
+            )
+            return response
+
+        return mock.Mock(request=_request), calls
+
+    @override_settings(DEEZER_BACKOFF=0, DEEZER_RETRIES=3)
+    def test_retry(self):
+        quota = {'error': {'type': 'Exception', 'message': 'Quota', 'code': 4}}
+        session, calls = self._session(
+            (502, None), (200, quota), (200, {'data': [1]}),
+        )
+        limiter = mock.Mock()
+        with mock.patch.object(deezer_base, 'get_session', lambda: session), \
+                mock.patch.object(deezer_base, 'get_limiter', lambda: limiter):
+            self.assertEqual(deezer_base.request('url', {}), [1])
+        self.assertEqual(len(calls), 3)
+        # every attempt takes a token
+        self.assertEqual(limiter.acquire.call_count, 3)
+
+    @override_settings(DEEZER_BACKOFF=0, DEEZER_RETRIES=3)
+    def test_post_not_retried(self):
+        session, calls = self._session((502, None), (200, {'id': 1}))
+        with mock.patch.object(deezer_base, 'get_session', lambda: session):
+            with self.assertRaises(deezer_base.requests.HTTPError):
+                deezer_base.request('url', {}, method='post')
+        self.assertEqual(len(calls), 1)
+
+    def test_quota_buckets(self):
+        quotas = deezer_quota.Quotas(
+            calls=50, period=5, user_calls=10, endpoint_calls={'search': 40},
+        )
+        limiter = mock.Mock()
+        session, _ = self._session((200, {'data': []}))
+        with mock.patch.object(deezer_base, 'get_session', lambda: session), \
+                mock.patch.object(deezer_base, 'get_limiter', lambda: limiter):
+            deezer_base.request(
+                'https://api.deezer.com/search/album', {'access_token': 'a'},
+            )
+
+        [(endpoint, user), _] = limiter.acquire.call_args
+        self.assertEqual(endpoint, 'search')
+        self.assertEqual(
+            [name for name, *_ in quotas.buckets(endpoint, user)],
+            [f'user:{user}', 'endpoint:search', deezer_quota.APP],
+        )
+        self.assertEqual(
+            [name for name, *_ in quotas.buckets('playlist', None)],
+            [deezer_quota.APP],
+        )
+
+    def test_local_limiter(self):
+        limiter = deezer_quota.LocalLimiter(deezer_quota.Quotas(
+            calls=3, period=0.2, user_calls=1, endpoint_calls={},
+        ))
+        start = time.monotonic()
+        limiter.acquire('search', 'a')
+        limiter.acquire('search', 'b')
+        self.assertLess(time.monotonic() - start, 0.2)
+        limiter.acquire('search', 'a')
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    @override_settings(DEEZER_RETRIES=0)
+    def test_circuit_breaker(self):
+        breaker = deezer_breaker.CircuitBreaker(
+            window=60, min_calls=2, error_rate=0.5, slow_call=10,
+            slow_rate=0.5, open_time=0.1,
+        )
+        session, calls = self._session(
+            (200, {'data': []}), (500, None), (200, {'data': [1]}),
+        )
+        url = 'https://api.deezer.com/search'
+        with mock.patch.object(deezer_base, 'get_session', lambda: session), \
+                mock.patch.object(deezer_base, 'get_breaker', lambda: breaker):
+            deezer_base.request(url, {})
+            with self.assertRaises(deezer_base.requests.HTTPError):
+                deezer_base.request(url, {})
+            self.assertEqual(breaker.state('search'), deezer_breaker.OPEN)
+            with self.assertRaises(deezer_base.DeezerUnavailable):
+                deezer_base.request(url, {})
+            self.assertEqual(len(calls), 2)
+
+            breaker.wait('search')
+            self.assertEqual(breaker.state('search'), deezer_breaker.HALF_OPEN)
+            self.assertEqual(deezer_base.request(url, {}), [1])
+
+        self.assertEqual(breaker.stats(), {'search': dict(
+            state=deezer_breaker.CLOSED, calls=0, errors=0, slow=0,
+        )})
+
+    def test_wait_probe(self):
+        breaker = deezer_breaker.CircuitBreaker(
+            window=60, min_calls=1, error_rate=0.5, slow_call=10,
+            slow_rate=0.5, open_time=0,
+        )
+        breaker.record('search', 0, True)
+        breaker.before('search')
+        timer = threading.Timer(0.1, breaker.record, ('search', 0, False))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        start = time.monotonic()
+        breaker.wait('search')
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        self.assertEqual(breaker.state('search'), deezer_breaker.CLOSED)
+
+    def test_search_half_open(self):
+        breaker = deezer_breaker.CircuitBreaker(
+            window=60, min_calls=1, error_rate=0.5, slow_call=10,
+            slow_rate=0.5, open_time=0,
+        )
+        breaker.record('search', 0, True)
+        calls = []
+
+        def _request_many(tracks, query):
+            calls.append(tracks)
+            breaker.before('search')
+            breaker.record('search', 0, False)
+            return matching._done({track: [] for track in tracks})
+
+        with mock.patch.object(matching, 'get_breaker', lambda: breaker):
+            responses = matching._request_available(
+                _request_many, ['a', 'b', 'c'],
+            )
+        # the probe is searched alone
+        self.assertEqual(calls, [['a'], ['b', 'c']])
+        self.assertEqual(list(responses.result()), ['a', 'b', 'c'])
+
+    def test_probe_released(self):
+        breaker = deezer_breaker.CircuitBreaker(
+            window=60, min_calls=1, error_rate=0.5, slow_call=10,
+            slow_rate=0.5, open_time=0,
+        )
+        breaker.record('search', 0, True)
+        limiter = mock.Mock()
+        limiter.acquire.side_effect = RuntimeError('limiter failed')
+        with mock.patch.object(deezer_base, 'get_breaker', lambda: breaker), \
+                mock.patch.object(deezer_base, 'get_limiter', lambda: limiter):
+            for _ in range(2):
+                with self.assertRaises(RuntimeError):
+                    deezer_base.request('https://api.deezer.com/search', {})
+        self.assertEqual(breaker.state('search'), deezer_breaker.HALF_OPEN)
+
+    @override_settings(DEEZER_BACKOFF=0, DEEZER_RETRIES=1)
+    def test_retries_exceeded(self):
+        session, calls = self._session((500, None), (503, None))
+        with mock.patch.object(deezer_base, 'get_session', lambda: session):
+            with self.assertRaises(deezer_base.requests.HTTPError):
+                deezer_base.request('url', {})
+        self.assertEqual(len(calls), 2)
+
+
+class DeezerAsyncTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+
+    def _serve(self, handler, coro):
+        """ Runs `coro(session, url)` against local server of `handler` """
+        async def _run():
+            app = web.Application()
+            app.router.add_get('/search', handler)
+            async with TestServer(app) as server, \
+                    deezer_async.client_session() as session:
+                return await coro(session, str(server.make_url('/search')))
+
+        return asyncio.run(_run())
+
+    @override_settings(DEEZER_BACKOFF=0)
+    def test_request_retried(self):
+        statuses = [502, 200]
+
+        async def _handler(request):
+            status = statuses.pop(0)
+            return web.json_response({'data': [request.query['q']]}, status=status)
+
+        limiter = mock.Mock()
+        with mock.patch.object(deezer_async, 'get_limiter', lambda: limiter):
+            data = self._serve(
+                _handler, lambda session, url: deezer_async.request(
+                    session, url, {'q': 'query'},
+                ),
+            )
+        self.assertEqual(data, ['query'])
+        self.assertEqual(statuses, [])
+        self.assertEqual(limiter.acquire.call_count, 2)
+
+    def test_cancelled_probe_released(self):
+        breaker = deezer_breaker.CircuitBreaker(
+            window=60, min_calls=1, error_rate=0.5, slow_call=10,
+            slow_rate=0.5, open_time=0,
+        )
+        breaker.record('search', 0, True)
+        limiter = mock.Mock()
+        limiter.acquire.side_effect = lambda *args: time.sleep(0.1)
+
+        async def _run():
+            task = asyncio.ensure_future(deezer_async._request(
+                None, 'https://api.deezer.com/search', {}, 'get',
+            ))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with mock.patch.object(deezer_async, 'get_breaker', lambda: breaker), \
+                mock.patch.object(deezer_async, 'get_limiter', lambda: limiter):
+            asyncio.run(_run())
+        # the probe is free again
+        breaker.before('search')
+
+    def test_combined(self):
+        track = create_user_track(self.user)
+        track.album = strand()
+        good = dict(
+            deezer_track_info(), title=track.title,
+            artist={'name': track.artist}, album={'title': track.album},
+        )
+        poor = deezer_track_info()
+        queries = deezer_search.combined_queries(track)
+        responses = {queries[1]: [poor], queries[3]: [good]}
+
+        async def _search(session, query, token=None, limit=None):
+            return responses.get(query, [])
+
+        with mock.patch.object(deezer_async, 'search', _search):
+            for strategy, expected in (
+                (deezer_search.SEQUENTIAL, [poor]),
+                (deezer_search.EARLY_EXIT, [good]),
+                (deezer_search.CONCURRENT, [good]),
+            ):
+                deezer_data = asyncio.run(deezer_async.combined(
+                    None, track, strategy=strategy,
+                ))
+                self.assertEqual(deezer_data, expected)
+
+    @override_settings(DEEZER_SEARCH_CLIENT='asyncio')
+    def test_search_library_tracks(self):
+        tracks = [create_user_track(self.user) for _ in range(3)]
+
+        async def _request(session, url, params):
+            if params['q'] == deezer_search.simple_query(tracks[0]):
+                raise deezer_base.DeezerResponseError('Exception', 'Quota', 4)
+            return [deezer_track_info()]
+
+        with mock.patch.object(deezer_async, 'request', _request):
+            progress = matching.search_library_tracks(self.user.id)
+
+        self.assertEqual((progress['matched'], progress['failed']), (2, 1))
+
+    @override_settings(
+        DEEZER_SEARCH_CLIENT='asyncio', SEARCH_CHUNK_SIZE=2,
+        DEEZER_ASYNC_CONNECTIONS=4,
+    )
+    def test_search_job_in_flight(self):
+        for _ in range(8):
+            create_user_track(self.user)
+        in_flight, peak, sessions = [0], [0], []
+
+        async def _request(session, url, params):
+            sessions.append(session)
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+            await asyncio.sleep(0.05)
+            in_flight[0] -= 1
+            return [deezer_track_info()]
+
+        with mock.patch.object(deezer_async, 'request', _request):
+            progress = matching.search_library_tracks(self.user.id)
+
+        self.assertEqual(progress['matched'], 8)
+        # searches of next chunks are in flight together, by one session
+        self.assertEqual(peak[0], 4)
+        self.assertEqual(len(set(map(id, sessions))), 1)
+
+
+class FakeDeezerTestCase(TestCase):
+    def _serve(self, simulation, coro):
+        """ Runs `coro(session, url)` against fake Deezer API """
+        async def _run():
+            app = fake_deezer.make_app(simulation)
+            async with TestServer(app) as server, \
+                    deezer_async.client_session() as session:
+                return await coro(session, str(server.make_url('')).rstrip('/'))
+
+        return asyncio.run(_run())
+
+    def test_search_and_playlist(self):
+        track = create_user_track(md.User.objects.create_user(strand()))
+
+        async def _coro(session, url):
+            data = await deezer_async.request(
+                session, f'{url}/search',
+                {'q': deezer_search.advanced_query(track, with_album=False)},
+            )
+            playlist = await deezer_async.request(
+                session, f'{url}/user/me/playlists',
+                {'title': 'test', 'access_token': 'a'}, method='post',
+            )
+            await deezer_async.request(
+                session, f'{url}/playlist/{playlist["id"]}/tracks',
+                {'songs': str(data[0]['id']), 'access_token': 'a'},
+                method='post',
+            )
+            return data, await deezer_async.request(
+                session, f'{url}/playlist/{playlist["id"]}', {},
+            )
+
+        data, info = self._serve(fake_deezer.Simulation(), _coro)
+        self.assertEqual(
+            (data[0]['artist']['name'], data[0]['title']),
+            (track.artist, track.title),
+        )
+        self.assertEqual(info['tracks']['data'], [{'id': data[0]['id']}])
+
+    @override_settings(DEEZER_RETRIES=0)
+    def test_quota(self):
+        async def _coro(session, url):
+            await deezer_async.request(session, f'{url}/search', {'q': 'a'})
+            await deezer_async.request(session, f'{url}/search', {'q': 'a'})
+
+        with self.assertRaises(deezer_base.DeezerResponseError) as context:
+            self._serve(fake_deezer.Simulation(quota_calls=1), _coro)
+        self.assertEqual(context.exception.code, deezer_base.QUOTA_EXCEEDED)
+
+
+class DeezerSearchTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+
+    def test_rate_limiter(self):
+        limiter = deezer_quota.RateLimiter(calls=2, period=0.2)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_request_many(self):
+        tracks = [create_user_track(self.user) for _ in range(3)]
+        responses = {
+            deezer_search.simple_query(tracks[0]): [deezer_track_info(1)],
+            deezer_search.simple_query(tracks[1]): [],
+        }
+
+        def _request(url, params):
+            if params['q'] in responses:
+                return responses[params['q']]
+            raise deezer_base.DeezerResponseError('Exception', 'Quota', 4)
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            responses = deezer_search.request_many(tracks)
+        found = deezer_search.search_top_responses(responses, 1)
+
+        self.assertEqual(list(found), tracks[:2])
+        [(deezer_track, _)] = found[tracks[0]]
+        self.assertEqual(deezer_track.deezer_id, 1)
+        self.assertEqual(found[tracks[1]], [])
+
+    def test_from_deezer_many(self):
+        exists = md.DeezerTrack.from_deezer(deezer_track_info())
+        infos = [deezer_track_info(exists.deezer_id), deezer_track_info()]
+        infos.append(infos[1])
+
+        with self.assertNumQueries(2):
+            tracks = md.DeezerTrack.from_deezer_many(infos)
+
+        self.assertEqual(tracks[0], exists)
+        self.assertEqual(tracks[0].title, exists.title)
+        self.assertEqual(tracks[1], tracks[2])
+        self.assertEqual(tracks[1].title, infos[1]['title'])
+        self.assertEqual(md.DeezerTrack.objects.count(), 2)
+
+    def test_top_candidates(self):
+        track = create_user_track(self.user)
+        infos = [deezer_track_info() for _ in range(3)]
+        infos[2].update(title=track.title, artist={'name': track.artist})
+
+        best = scoring.top(track, infos, 2)
+
+        self.assertEqual([info for info, _ in best][0], infos[2])
+        for info, diff in best:
+            ti = md.TrackIdentity(
+                user_track=track,
+                deezer_track=md.DeezerTrack.from_deezer(info),
+            )
+            ti.set_diff()
+            self.assertEqual(diff, ti.diff)
+
+    def test_search_top_k(self):
+        track = create_user_track(self.user)
+        infos = [deezer_track_info() for _ in range(4)]
+        infos[1].update(title=track.title, artist={'name': track.artist})
+
+        with mock.patch.object(deezer_search, 'request', lambda *_: infos), \
+                override_settings(SEARCH_TOP_K=3):
+            matching.search_library_tracks(self.user.id)
+
+        identities = md.TrackIdentity.objects.filter(user_track=track)
+        self.assertEqual(identities.count(), 3)
+        self.assertEqual(
+            identities.get(chosen=True).deezer_track.deezer_id, infos[1]['id'],
+        )
+
+    def _combined_responses(self, track):
+        good = dict(
+            deezer_track_info(), title=track.title,
+            artist={'name': track.artist}, album={'title': track.album},
+        )
+        poor = deezer_track_info()
+        queries = deezer_search.combined_queries(track)
+        return good, poor, {
+            queries[0]: [poor], queries[1]: [], queries[2]: [good, poor],
+        }
+
+    def test_combined_sequential(self):
+        track = create_user_track(self.user)
+        track.album = strand()
+        good, poor, responses = self._combined_responses(track)
+        queries = []
+
+        def _request(url, params):
+            queries.append(params['q'])
+            return responses.get(params['q'], [])
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            found = deezer_search.combined(
+                track, one=True, strategy=deezer_search.SEQUENTIAL,
+            )
+            self.assertEqual(found.deezer_id, poor['id'])
+            # the first found candidate costs one request
+            self.assertEqual(queries, deezer_search.combined_queries(track)[:1])
+
+            # the next variants are requested, while nothing is found
+            track = create_user_track(self.user)
+            track.album = strand()
+            good, poor, responses = self._combined_responses(track)
+            del responses[deezer_search.combined_queries(track)[0]]
+            queries.clear()
+            found = deezer_search.combined(
+                track, one=True, strategy=deezer_search.SEQUENTIAL,
+            )
+            self.assertEqual(found.deezer_id, good['id'])
+            self.assertEqual(queries, deezer_search.combined_queries(track)[:3])
+
+    def test_combined_early_exit(self):
+        track = create_user_track(self.user)
+        track.album = strand()
+        good, poor, responses = self._combined_responses(track)
+        queries = []
+
+        def _request(url, params):
+            queries.append(params['q'])
+            return responses.get(params['q'], [])
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            found = deezer_search.combined(
+                track, one=True, strategy=deezer_search.EARLY_EXIT,
+            )
+        self.assertEqual(found.deezer_id, good['id'])
+        # poor candidate of the first variant does not stop the search
+        self.assertEqual(queries, deezer_search.combined_queries(track)[:3])
+
+    def test_combined_concurrent(self):
+        track = create_user_track(self.user)
+        track.album = strand()
+        good, poor, responses = self._combined_responses(track)
+
+        def _request(url, params):
+            return responses.get(params['q'], [])
+
+        with mock.patch.object(deezer_search, 'request', _request), \
+                override_settings(SEARCH_GOOD_DIFF=-1):
+            found = deezer_search.combined(
+                track, strategy=deezer_search.CONCURRENT,
+            )
+
+        self.assertEqual(
+            [deezer_track.deezer_id for deezer_track in found],
+            [good['id'], poor['id']],
+        )
+
+    def test_search_playlist_tracks(self):
+        playlist = create_playlist(self.user)
+        tracks = [create_user_track(self.user) for _ in range(3)]
+        playlist.itunes_content.add(*tracks)
+        task = CeleryTaskResult.objects.create(task_id=strand())
+        history = md.SearchHistory.create(
+            task_id=task.task_id, user_id=self.user.id,
+            playlist_id=playlist.id,
+        )
+
+        def _request(url, params):
+            if params['q'] == deezer_search.simple_query(tracks[0]):
+                raise deezer_base.DeezerResponseError('Exception', 'Quota', 4)
+            if params['q'] in deezer_search.combined_queries(tracks[1]):
+                return []
+            return [deezer_track_info()]
+
+        with mock.patch.object(deezer_search, 'request', _request), \
+                override_settings(SEARCH_CHUNK_SIZE=2):
+            matching.search_playlist_tracks(playlist, history)
+
+        history = md.SearchHistory.objects.get(pk=history.pk)
+        self.assertEqual(
+            (history.total, history.done, history.matched, history.failed),
+            (3, 3, 1, 1),
+        )
+        self.assertEqual(playlist.identities.count(), 1)
+
+    @override_settings(PAIRS_BATCH_SIZE=2)
+    def test_search_library_tracks(self):
+        tracks = [create_user_track(self.user) for _ in range(3)]
+        for _ in range(2):
+            create_playlist(self.user).itunes_content.add(*tracks)
+        # the track has candidates already, so it is not searched again
+        md.TrackIdentity.objects.create(
+            user_track=tracks[0], diff=1, chosen=False,
+            deezer_track=md.DeezerTrack.from_deezer(deezer_track_info()),
+        )
+
+        queries = []
+
+        def _request(url, params):
+            queries.append(params['q'])
+            return [deezer_track_info()]
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            progress = matching.search_library_tracks(self.user.id)
+
+        self.assertEqual(progress['total'], 2)
+        self.assertEqual(sorted(queries), sorted(
+            deezer_search.simple_query(track) for track in tracks[1:]))
+        self.assertEqual(md.TrackIdentity.objects.filter(
+            user_track__user=self.user, chosen=True).count(), 3)
+
+    def test_playlist_search_started_once(self):
+        playlist = create_playlist(self.user)
+        with mock.patch.object(matching.celery_app, 'send_task') as send_task:
+            self.assertTrue(matching.start_playlist_search(playlist, self.user))
+            self.assertFalse(matching.start_playlist_search(playlist, self.user))
+            send_task.assert_called_once()
+
+            # the task is done, so the playlist may be searched again
+            CeleryTaskResult.objects.update(status='SUCCESS')
+            self.assertTrue(matching.start_playlist_search(playlist, self.user))
+            with override_settings(SEARCH_TIMEOUT=0):
+                self.assertTrue(
+                    matching.start_playlist_search(playlist, self.user))
+        self.assertEqual(send_task.call_count, 3)
+        task_id = send_task.call_args[1]['task_id']
+        self.assertEqual(
+            md.SearchHistory.create(task_id, self.user.id, playlist.id),
+            md.SearchHistory.objects.get(task__task_id=task_id),
+        )
+
+    def test_concurrent_pairs_skipped(self):
+        paired, other = [create_user_track(self.user) for _ in range(2)]
+        deezer_tracks = md.DeezerTrack.from_deezer_many(
+            [deezer_track_info(), deezer_track_info()])
+        md.TrackIdentity.objects.create(
+            user_track=paired, deezer_track=deezer_tracks[0], diff=0,
+            chosen=True,
+        )
+        md.TrackIdentity.objects.create(
+            user_track=other, deezer_track=deezer_tracks[0], diff=5,
+        )
+        # pairs, which are saved by other search meanwhile
+        matching._save_identities([
+            md.TrackIdentity(
+                user_track=track, deezer_track=deezer_track, diff=0,
+                chosen=True,
+            )
+            for track in (paired, other) for deezer_track in deezer_tracks
+        ])
+        self.assertEqual(
+            paired.trackidentity_set.get(chosen=True).deezer_track,
+            deezer_tracks[0],
+        )
+        self.assertEqual(other.trackidentity_set.count(), 2)
+
+
+class AlbumSearchTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+        self.artist, self.album = strand(), strand()
+        self.tracks = [
+            md.UserTrack.objects.create(
+                itunes_id=intrand(), user=self.user, title=strand(),
+                artist=self.artist, album=self.album,
+            )
+            for _ in range(3)
+        ]
+        self.album_info = {
+            'id': intrand(), 'title': self.album,
+            'artist': {'name': self.artist},
+        }
+        # the last track is missed in Deezer album
+        self.album_tracks = [
+            {
+                'id': intrand(), 'title': track.title,
+                'artist': {'name': self.artist},
+            }
+            for track in self.tracks[:2]
+        ] + [deezer_track_info()]
+
+    def test_search_by_album(self):
+        urls, queries = [], []
+
+        def _album_request(url, params):
+            urls.append(url)
+            if url == deezer_album.SEARCH_URL:
+                return [deezer_track_info(), self.album_info]
+            return self.album_tracks
+
+        def _search_request(url, params):
+            queries.append(params['q'])
+            return []
+
+        with mock.patch.object(deezer_album, 'request', _album_request), \
+                mock.patch.object(deezer_search, 'request', _search_request):
+            progress = matching.search_library_tracks(self.user.id)
+
+        self.assertEqual(urls, [
+            deezer_album.SEARCH_URL,
+            deezer_album.TRACKS_URL.format(album_id=self.album_info['id']),
+        ])
+        self.assertEqual(
+            sorted(queries),
+            sorted(deezer_search.combined_queries(self.tracks[2])),
+        )
+        self.assertEqual((progress['done'], progress['matched']), (3, 2))
+        for track, track_info in zip(self.tracks, self.album_tracks[:2]):
+            identity = md.TrackIdentity.objects.get(user_track=track)
+            self.assertEqual(identity.diff, 0)
+            self.assertEqual(identity.deezer_track.deezer_id, track_info['id'])
+            self.assertEqual(identity.deezer_track.album, self.album)
+
+    def test_small_album_not_grouped(self):
+        self.tracks[0].delete()
+        urls = []
+
+        def _album_request(url, params):
+            urls.append(url)
+            return []
+
+        with mock.patch.object(deezer_album, 'request', _album_request), \
+                mock.patch.object(deezer_search, 'request', lambda *_: []):
+            progress = matching.search_library_tracks(self.user.id)
+        self.assertEqual(urls, [])
+        self.assertEqual((progress['done'], progress['matched']), (2, 0))
+
+    def test_known_tracks_not_grouped(self):
+        md.DeezerMatch.objects.create(
+            key=self.tracks[0].search_key, diff=0,
+            deezer_track=md.DeezerTrack.from_deezer(deezer_track_info()),
+        )
+        md.DeezerMiss.remember([self.tracks[1]])
+        urls = []
+
+        def _album_request(url, params):
+            urls.append(url)
+            return []
+
+        with mock.patch.object(deezer_album, 'request', _album_request), \
+                mock.patch.object(deezer_search, 'request', lambda *_: []):
+            progress = matching.search_library_tracks(self.user.id)
+        self.assertEqual(urls, [])
+        self.assertEqual(progress['indexed'], 1)
+
+
+class DeezerMatchTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+        self.track = create_user_track(self.user)
+        info = deezer_track_info()
+        info.update(title=self.track.title, artist={'name': self.track.artist})
+        self.deezer_track = md.DeezerTrack.from_deezer(info)
+
+    def _choose(self, user_track, deezer_track):
+        return md.TrackIdentity.create_or_update(
+            user_track=user_track, deezer_track=deezer_track, chosen=True,
+        )
+
+    def test_chosen_pair_shared(self):
+        self._choose(self.track, self.deezer_track)
+
+        other_user = md.User.objects.create_user(strand())
+        same_track = md.UserTrack.objects.create(
+            itunes_id=intrand(), user=other_user,
+            title=f' {self.track.title.upper()}', artist=self.track.artist,
+        )
+        task = CeleryTaskResult.objects.create(task_id=strand())
+        history = md.SearchHistory.create(
+            task_id=task.task_id, user_id=other_user.id,
+        )
+
+        def _request(url, params):
+            raise AssertionError('index must be used')
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            matching.search_library_tracks(other_user.id, history)
+
+        history = md.SearchHistory.objects.get(pk=history.pk)
+        self.assertEqual((history.matched, history.indexed), (1, 1))
+        identity = md.TrackIdentity.objects.get(user_track=same_track)
+        self.assertEqual(
+            (identity.deezer_track, identity.chosen),
+            (self.deezer_track, True),
+        )
+        self.assertEqual(md.DeezerMatch.objects.get().hits, 1)
+
+    def test_best_pair_kept(self):
+        worse = md.DeezerTrack.from_deezer(dict(
+            deezer_track_info(), title=self.track.title + 'x',
+            artist={'name': self.track.artist},
+        ))
+        other_track = md.UserTrack.objects.create(
+            itunes_id=intrand(), user=self.user,
+            title=self.track.title, artist=self.track.artist,
+        )
+        self._choose(self.track, worse)
+        self._choose(other_track, self.deezer_track)
+        self.assertEqual(md.DeezerMatch.objects.get().diff, 0)
+
+        # rejected pair is not shared anymore
+        identity = md.TrackIdentity.objects.get(user_track=other_track)
+        identity.chosen = False
+        identity.save()
+        self.assertFalse(md.DeezerMatch.objects.exists())
+
+    def test_used_pair_kept(self):
+        identity = self._choose(self.track, self.deezer_track)
+        md.DeezerMatch.objects.update(hits=1)
+
+        identity.chosen = False
+        identity.save()
+        self.assertEqual(md.DeezerMatch.objects.get().hits, 0)
+        md.DeezerMatch.forget(identity)
+        self.assertFalse(md.DeezerMatch.objects.exists())
+
+    def test_bad_pair_not_shared(self):
+        self._choose(self.track, md.DeezerTrack.from_deezer(deezer_track_info()))
+        self.assertFalse(md.DeezerMatch.objects.exists())
+
+
+class DuplicatesSearchTestCase(TestCase):
+    def test_duplicates_searched_once(self):
+        user = md.User.objects.create_user(strand())
+        track = create_user_track(user)
+        duplicate = md.UserTrack.objects.create(
+            itunes_id=intrand(), user=user,
+            title=track.title.upper(), artist=f' {track.artist}  ',
+        )
+        other = create_user_track(user)
+        queries = []
+
+        def _request(url, params):
+            queries.append(params['q'])
+            return [deezer_track_info()]
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            progress = matching.search_library_tracks(user.id)
+
+        self.assertEqual(sorted(queries), sorted(
+            deezer_search.simple_query(t) for t in (track, other)))
+        self.assertEqual((progress['done'], progress['matched']), (3, 3))
+        pairs = md.TrackIdentity.objects.filter(chosen=True)
+        self.assertEqual(
+            pairs.get(user_track=track).deezer_track,
+            pairs.get(user_track=duplicate).deezer_track,
+        )
+
+
+class DeezerMissTestCase(TestCase):
+    def setUp(self):
+        self.user = md.User.objects.create_user(strand())
+        self.track = create_user_track(self.user)
+        self.queries = []
+
+    def _request(self, url, params):
+        self.queries.append(params['q'])
+        return []
+
+    def test_missed_not_searched(self):
+        with mock.patch.object(deezer_search, 'request', self._request):
+            self.assertIsNone(deezer_search.combined(self.track, one=True))
+            self.assertEqual(len(self.queries), 2)
+            self.assertIsNone(deezer_search.combined(self.track, one=True))
+            matching.search_library_tracks(self.user.id)
+        self.assertEqual(len(self.queries), 2)
+
+    def test_job_remembers_missed(self):
+        tracks = [self.track] + [create_user_track(self.user) for _ in range(2)]
+        with mock.patch.object(deezer_search, 'request', self._request):
+            progress = matching.search_library_tracks(self.user.id)
+            # every variant of `combined_queries` is tried before
+            self.assertEqual(len(self.queries), 2 * len(tracks))
+            self.assertEqual(progress['failed'], 0)
+            matching.search_library_tracks(self.user.id)
+        self.assertEqual(len(self.queries), 2 * len(tracks))
+        self.assertEqual(md.DeezerMiss.missed(tracks), set(tracks))
+
+    def test_failed_not_remembered(self):
+        def _request(url, params):
+            if self.queries:
+                raise deezer_base.DeezerResponseError('Exception', 'Error', 0)
+            return self._request(url, params)
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            progress = matching.search_library_tracks(self.user.id)
+        self.assertEqual(progress['failed'], 1)
+        self.assertFalse(md.DeezerMiss.objects.exists())
+
+    def test_miss_expired(self):
+        with override_settings(DEEZER_MISS_TTL=0):
+            md.DeezerMiss.remember([self.track])
+        self.assertFalse(md.DeezerMiss.missed([self.track]))
+
+    def test_forget_on_edit(self):
+        md.DeezerMiss.remember([self.track])
+        self.client.force_login(self.user)
+        self.client.post(self.track.get_absolute_url(), {
+            '_s_title': strand(), '_s_artist': '', '_s_album': '',
+        })
+        self.assertFalse(md.DeezerMiss.objects.exists())
+
+
+class DeezerCacheTestCase(TestCase):
+    def test_memory_cache(self):
+        cache = deezer_cache.MemoryCache(ttl=60, max_size=2)
+        cache.set('a', [1])
+        cache.set('b', [2])
+        self.assertEqual(cache.get('a'), [1])
+        cache.set('c', [3])  # `b` is the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), [3])
+        self.assertEqual(
+            cache.stats(),
+            dict(backend='memory', hits=2, misses=1, size=2),
+        )
+
+    def test_memory_cache_ttl(self):
+        cache = deezer_cache.MemoryCache(ttl=0, max_size=2)
+        cache.set('a', [1])
+        self.assertIsNone(cache.get('a'))
+
+    def test_redis_unavailable(self):
+        cache = deezer_cache.RedisCache(
+            'redis://localhost:1/0', ttl=60, max_size=2)
+        cache.set('a', [1])
+        self.assertIsNone(cache.get('a'))
+
+    def test_search_cached(self):
+        query = f'Artist {strand()} - Title'
+        calls = []
+
+        def _request(url, params):
+            calls.append(params['q'])
+            return [deezer_track_info()]
+
+        with mock.patch.object(deezer_search, 'request', _request):
+            first = deezer_search._search(query, one=True)
+            second = deezer_search._search(f'  {query.lower()} ', one=True)
+
+        self.assertEqual(calls, [query])
+        self.assertEqual(first, second)
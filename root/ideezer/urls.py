@@ -17,7 +17,7 @@ Including another URLconf
 from django.urls import path
 from django.views.generic import TemplateView
 
-from .views import auth, library, tracks, playlists
+from .views import auth, library, tracks, playlists, stats
 
 urlpatterns = [
     path(r'logout', auth.logout, name='logout'),
@@ -26,14 +26,18 @@ urlpatterns = [
     path(r'upload_library', library.upload_library, name='upload_library'),
     path(r'upload_history', library.UploadHistoryListView.as_view(), name='upload_history'),
     path(r'tracks', tracks.TrackListView.as_view(), name='track_list'),
+    path(r'library_search', tracks.library_search, name='library_search'),
+    path(r'library_search_status', tracks.library_search_status, name='library_search_status'),
     path(r'track/<int:pk>', tracks.UserTrackEdit.as_view(), name='track_edit'),
     path(r'set_track_identity/<int:track_id>/<int:identity_id>', tracks.set_track_identity, name='set_track_identity'),
     path(r'search_track_from_playlist/<int:tid>/<int:pid>', tracks.search_track_from_playlist, name='search_track_from_playlist'),
     path(r'search_track_from_track/<int:tid>', tracks.search_track_from_track, name='search_track_from_track'),
     path(r'playlists', playlists.PlaylistListView.as_view(), name='playlist_list'),
     path(r'playlist/<int:pk>', playlists.PlaylistDetailView.as_view(), name='playlist_detail'),
+    path(r'deezer_stats', stats.deezer_stats, name='deezer_stats'),
     path(r'license', TemplateView.as_view(template_name='ideezer/license.html'), name='license'),
     path(r'playlist_search_simple/<int:pk>', playlists.playlist_search_simple, name='playlist_search_simple'),
+    path(r'playlist_search_status/<int:pk>', playlists.playlist_search_status, name='playlist_search_status'),
     path(r'playlist_deezer_create/<int:pk>', playlists.playlist_deezer_create, name='playlist_deezer_create'),
     path(r'identity_clear/<int:pk>/<int:playlist_from>', playlists.identity_clear, name='identity_clear'),
     path(r'', TemplateView.as_view(template_name='ideezer/main.html'), name='main'),
@@ -20,9 +20,14 @@ def upload_library(request):
     if request.method == 'POST':
         form = UploadLibraryForm(request.POST, request.FILES)
         if form.is_valid():  # TODO custom file validation here?
-            library.save(file=request.FILES['file'], user=request.user)
-            messages.success(
-                request, 'Upload success. Processing make take a few minutes.')
+            if library.save(file=request.FILES['file'], user=request.user):
+                messages.success(
+                    request,
+                    'Upload success. Processing make take a few minutes.')
+            else:
+                messages.info(
+                    request,
+                    'Library is the same as the last uploaded one.')
             return redirect('main')
     else:
         form = UploadLibraryForm()
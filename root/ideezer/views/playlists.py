@@ -1,13 +1,14 @@
 import logging
 
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseNotFound
+from django.http import HttpResponseNotFound, JsonResponse
 from django.views import generic as gc
 from django.shortcuts import redirect, get_object_or_404
 
 from .base import UserFilterViewMixin
 from .. import models as md
-from ..controllers import deezer_playlist, deezer_search
+from ..controllers import deezer_playlist, matching
 from ..decorators.views import decorate_cbv, paginated_cbv
 
 
@@ -35,6 +36,8 @@ class PlaylistDetailView(UserFilterViewMixin, gc.DetailView):
 
         context['paired'] = self.obj.identities
         context['unpaired'] = self.obj.unpaired
+        context['search'] = md.SearchHistory.objects.filter(
+            playlist=self.obj).first()
         return context
 
 
@@ -43,26 +46,23 @@ def playlist_search_simple(request, pk):
     playlist: md.Playlist = get_object_or_404(
         md.Playlist, pk=pk, user=request.user,
     )
-
-    identities = []
-    for track in playlist.itunes_content.all():
-        if md.TrackIdentity.mark_exists_track_as_pair(user_track=track):
-            continue
-
-        deezer_track = deezer_search.simple(track, one=True)
-        if not deezer_track:
-            continue
-        ti = md.TrackIdentity(
-            user_track=track, deezer_track=deezer_track,
-            chosen=True,
-        )
-        ti.set_diff()
-        identities.append(ti)
-    md.TrackIdentity.objects.bulk_create(identities)
+    if matching.start_playlist_search(playlist=playlist, user=request.user):
+        messages.success(request, 'Search started.')
+    else:
+        messages.info(request, 'Search is already in progress.')
 
     return redirect('playlist_detail', pk)
 
 
+@login_required
+def playlist_search_status(request, pk):
+    playlist: md.Playlist = get_object_or_404(
+        md.Playlist, pk=pk, user=request.user,
+    )
+    search = md.SearchHistory.objects.filter(playlist=playlist).first()
+    return JsonResponse(search.as_dict() if search else {})
+
+
 @login_required
 def playlist_deezer_create(request, pk):
     playlist: md.Playlist = get_object_or_404(
@@ -86,6 +86,8 @@ def identity_clear(request, pk, playlist_from):
     if identity.user_track.user != request.user:
         return HttpResponseNotFound('Identity does not found')
 
+    if identity.chosen:
+        md.DeezerMatch.forget(identity)
     identity.delete()
 
     return redirect('playlist_detail', playlist_from)
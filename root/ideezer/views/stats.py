@@ -0,0 +1,32 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count, Sum
+from django.http import JsonResponse
+
+from .. import models as md
+from ..controllers import deezer_breaker, deezer_cache
+
+
+@staff_member_required
+def deezer_stats(request):
+    return JsonResponse({
+        'search_cache': deezer_cache.get_cache().stats(),
+        'match_index': _match_index_stats(),
+        # circuits of the web process
+        'circuits': deezer_breaker.get_breaker().stats(),
+    })
+
+
+def _match_index_stats() -> dict:
+    index = md.DeezerMatch.objects.aggregate(
+        size=Count('pk'), hits=Sum('hits'),
+    )
+    searches = md.SearchHistory.objects.aggregate(
+        done=Sum('done'), indexed=Sum('indexed'),
+    )
+    done = searches['done'] or 0
+    indexed = searches['indexed'] or 0
+    return dict(
+        size=index['size'], hits=index['hits'] or 0,
+        searched=done, indexed=indexed,
+        hit_rate=round(indexed / done, 4) if done else None,
+    )
@@ -1,13 +1,15 @@
 import logging
 
+from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
 from django.views import generic as gc
 from django.shortcuts import redirect, get_object_or_404
 from django.views.generic.edit import UpdateView
 
 from .base import UserFilterViewMixin
 from .. import models as md
-from ..controllers import deezer_search
+from ..controllers import deezer_search, matching
 from ..decorators.views import decorate_cbv, paginated_cbv
 
 logger = logging.getLogger(__name__)
@@ -19,6 +21,30 @@ class TrackListView(UserFilterViewMixin, gc.ListView):
     template_name = 'ideezer/track_list.html'
     model = md.UserTrack
 
+    def get_context_data(self, **kwargs):
+        context = super(TrackListView, self).get_context_data(**kwargs)
+        context['search'] = _library_search(self.request.user)
+        return context
+
+
+def _library_search(user):
+    return md.SearchHistory.objects.by_user(user.id).filter(
+        playlist__isnull=True,
+    ).first()
+
+
+@login_required
+def library_search(request):
+    matching.start_library_search(user=request.user)
+    messages.success(request, 'Search started.')
+    return redirect('track_list')
+
+
+@login_required
+def library_search_status(request):
+    search = _library_search(request.user)
+    return JsonResponse(search.as_dict() if search else {})
+
 
 @decorate_cbv(login_required)
 class UserTrackEdit(UpdateView):
@@ -40,6 +66,12 @@ class UserTrackEdit(UpdateView):
                 context['identities'].append(identity)
         return context
 
+    def form_valid(self, form):
+        # track with changed search attributes should be searched again
+        saved = md.UserTrack.objects.get(pk=self.object.pk)
+        md.DeezerMiss.forget([saved, self.object])
+        return super(UserTrackEdit, self).form_valid(form)
+
 
 def set_track_identity(request, track_id, identity_id):
     user_track = get_object_or_404(md.UserTrack, pk=track_id)
@@ -172,6 +172,64 @@ DEEZER_APP_ID = env('DEEZER_APP_ID', default=None)
 DEEZER_APP_NAME = env('DEEZER_APP_NAME', default=None)
 DEEZER_SECRET_KEY = env('DEEZER_SECRET_KEY', default=None)
 DEEZER_BASE_PERMS = env('DEEZER_BASE_PERMS', default='basic_access,email,manage_library')
+# Deezer API and OAuth hosts, e.g. `http://localhost:8001` of `ideezer.fake_deezer`
+DEEZER_API_URL = env('DEEZER_API_URL', default='https://api.deezer.com')
+DEEZER_CONNECT_URL = env('DEEZER_CONNECT_URL', default='https://connect.deezer.com')
+# Deezer API quota: `DEEZER_QUOTA_CALLS` requests per `DEEZER_QUOTA_PERIOD` sec
+DEEZER_QUOTA_CALLS = env.int('DEEZER_QUOTA_CALLS', default=50)
+DEEZER_QUOTA_PERIOD = env.float('DEEZER_QUOTA_PERIOD', default=5)
+# the same quota for requests of one Deezer user (0 - unlimited)
+DEEZER_USER_QUOTA_CALLS = env.int('DEEZER_USER_QUOTA_CALLS', default=DEEZER_QUOTA_CALLS)
+# quotas of API endpoints, e.g. `search=40,playlist=10`
+DEEZER_ENDPOINT_QUOTAS = env.dict('DEEZER_ENDPOINT_QUOTAS', default={})
+# quota buckets: `memory` (per process) or `redis` (shared by all processes)
+DEEZER_LIMITER_BACKEND = env('DEEZER_LIMITER_BACKEND', default='memory')
+DEEZER_SEARCH_WORKERS = env.int('DEEZER_SEARCH_WORKERS', default=10)
+# search jobs request Deezer by `threads` (`DEEZER_SEARCH_WORKERS`) or from
+# `asyncio` event loop (`DEEZER_ASYNC_CONNECTIONS` connections at most)
+DEEZER_SEARCH_CLIENT = env('DEEZER_SEARCH_CLIENT', default='threads')
+DEEZER_ASYNC_CONNECTIONS = env.int('DEEZER_ASYNC_CONNECTIONS', default=100)
+# Deezer API connections: kept alive connections count, timeouts (sec),
+# retries of failed requests with exponential backoff (sec)
+DEEZER_POOL_SIZE = env.int('DEEZER_POOL_SIZE', default=DEEZER_SEARCH_WORKERS)
+DEEZER_CONNECT_TIMEOUT = env.float('DEEZER_CONNECT_TIMEOUT', default=5)
+DEEZER_READ_TIMEOUT = env.float('DEEZER_READ_TIMEOUT', default=30)
+DEEZER_RETRIES = env.int('DEEZER_RETRIES', default=3)
+DEEZER_BACKOFF = env.float('DEEZER_BACKOFF', default=0.5)
+# Deezer API endpoint is not requested for `DEEZER_BREAKER_OPEN_TIME` sec,
+# when rate of failed or slow calls for the last `DEEZER_BREAKER_WINDOW` sec
+# is too high (see `ideezer.controllers.deezer_breaker`)
+DEEZER_BREAKER_WINDOW = env.float('DEEZER_BREAKER_WINDOW', default=60)
+DEEZER_BREAKER_MIN_CALLS = env.int('DEEZER_BREAKER_MIN_CALLS', default=10)
+DEEZER_BREAKER_ERROR_RATE = env.float('DEEZER_BREAKER_ERROR_RATE', default=0.5)
+DEEZER_BREAKER_SLOW_CALL = env.float('DEEZER_BREAKER_SLOW_CALL', default=10)
+DEEZER_BREAKER_SLOW_RATE = env.float('DEEZER_BREAKER_SLOW_RATE', default=0.5)
+DEEZER_BREAKER_OPEN_TIME = env.float('DEEZER_BREAKER_OPEN_TIME', default=30)
+# variants of track search are requested `sequential`, `early_exit`
+# (one by one too) or `concurrent`
+DEEZER_SEARCH_STRATEGY = env('DEEZER_SEARCH_STRATEGY', default='sequential')
+# early exit and concurrent track search stop, when candidate diff is up to
+# this value (sequential one stops at the first found candidate)
+SEARCH_GOOD_DIFF = env.int('SEARCH_GOOD_DIFF', default=3)
+# Deezer search responses cache: `memory`, `redis` or `none`
+DEEZER_CACHE_BACKEND = env('DEEZER_CACHE_BACKEND', default='memory')
+DEEZER_CACHE_TTL = env.int('DEEZER_CACHE_TTL', default=24 * 60 * 60)
+DEEZER_CACHE_MAX_SIZE = env.int('DEEZER_CACHE_MAX_SIZE', default=10000)
+# search progress is saved after every chunk of tracks
+SEARCH_CHUNK_SIZE = env.int('SEARCH_CHUNK_SIZE', default=50)
+# existing candidates are marked as chosen pairs by chunks of this size
+PAIRS_BATCH_SIZE = env.int('PAIRS_BATCH_SIZE', default=500)
+# closest Deezer candidates kept for every searched track
+SEARCH_TOP_K = env.int('SEARCH_TOP_K', default=5)
+# albums of `ALBUM_MIN_TRACKS` tracks or more are searched as a whole,
+# album tracks with diff up to `ALBUM_MATCH_MAX_DIFF` are paired
+SEARCH_BY_ALBUM = env.bool('SEARCH_BY_ALBUM', default=True)
+ALBUM_MIN_TRACKS = env.int('ALBUM_MIN_TRACKS', default=3)
+ALBUM_MATCH_MAX_DIFF = env.int('ALBUM_MATCH_MAX_DIFF', default=5)
+# chosen pairs with greater diff are not shared between users
+MATCH_INDEX_MAX_DIFF = env.int('MATCH_INDEX_MAX_DIFF', default=10)
+# tracks not found by Deezer are not searched again for this time (sec)
+DEEZER_MISS_TTL = env.int('DEEZER_MISS_TTL', default=7 * 24 * 60 * 60)
 
 
 logger = logging.getLogger(__name__)
@@ -189,4 +247,23 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+DEEZER_CACHE_REDIS_URL = env('DEEZER_CACHE_REDIS_URL', default=CELERY_BROKER_URL)
+DEEZER_LIMITER_REDIS_URL = env('DEEZER_LIMITER_REDIS_URL', default=CELERY_BROKER_URL)
+
 UPLOAD_PATH = env('UPLOAD_PATH', default=None)
+# `stream` or `libpytunes` (loads the whole library in memory)
+ITUNES_XML_PARSER = env('ITUNES_XML_PARSER', default='stream')
+IMPORT_BATCH_SIZE = env.int('IMPORT_BATCH_SIZE', default=1000)
+# max count of parsed, but not written chunks
+IMPORT_QUEUE_SIZE = env.int('IMPORT_QUEUE_SIZE', default=4)
+# `bulk` or `copy` (PostgreSQL only, `bulk` is used for other databases)
+IMPORT_LOADER = env('IMPORT_LOADER', default='bulk')
+# `incremental` (re-import changed tracks only), `full` (reload all library)
+# or `resumable` (`full` with checkpoints, retried task continues import)
+ITUNES_IMPORT_MODE = env('ITUNES_IMPORT_MODE', default='incremental')
+# resumable import, which checkpoint is not updated for this time (sec),
+# is considered dead, so other import of the user may start
+IMPORT_CHECKPOINT_TIMEOUT = env.int('IMPORT_CHECKPOINT_TIMEOUT', default=3600)
+# playlist search, which task is not updated for this time (sec), is
+# considered dead, so other search of the playlist may start
+SEARCH_TIMEOUT = env.int('SEARCH_TIMEOUT', default=3600)